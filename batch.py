@@ -0,0 +1,131 @@
+"""
+离线批处理：读取OpenAI Batch API格式的JSONL，每行经与代理相同的工具调用转换后请求上游，结果按输入顺序写入输出JSONL
+
+OPENAI_API_KEY=... OPENAI_BASE_URL=... python batch.py input.jsonl output.jsonl [--concurrency 32]
+
+输入每行形如{"custom_id": "...", "method": "POST", "url": "/v1/chat/completions", "body": {...}}，输出每行形如
+{"id": "...", "custom_id": "...", "response": {"status_code": 200, "request_id": "...", "body": {...}}, "error": null}。
+中断后用相同的参数重新运行，从输出文件最后一个完整行之后继续。
+
+环境变量：
+    BATCH_CONCURRENCY：默认并发数
+    LOG_LEVEL：日志级别，默认INFO
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import secrets
+import sys
+import time
+from collections import deque
+from typing import Dict
+
+import ujson
+from loguru import logger
+from openai import APIStatusError
+
+from utilities.openai_tool import openai_stream
+
+# 每处理多少行打印一次进度
+PROGRESS_INTERVAL = 1000
+
+
+def _completed_lines(output_path: str) -> int:
+    """
+    输出文件中已完成的行数，上次中断时写了一半的行截掉
+    """
+    if not os.path.exists(output_path):
+        return 0
+    count = 0
+    last_newline = 0
+    offset = 0
+    with open(output_path, "rb") as f:
+        while block := f.read(1 << 20):
+            count += block.count(b"\n")
+            if (inx := block.rfind(b"\n")) >= 0:
+                last_newline = offset + inx + 1
+            offset += len(block)
+    if last_newline != offset:
+        logger.warning(f"truncate partial line at the end of {output_path}")
+        with open(output_path, "rb+") as f:
+            f.truncate(last_newline)
+    return count
+
+
+async def _run_line(line: str, semaphore: asyncio.Semaphore) -> Dict:
+    """
+    处理输入的一行，任何错误都记在该行的结果里，不中断整个批处理
+    """
+    result = {"id": f"batch_req_{secrets.token_hex(12)}", "custom_id": None, "response": None, "error": None}
+    try:
+        request = ujson.loads(line)
+        result["custom_id"] = request.get("custom_id")
+        if request.get("url") != "/v1/chat/completions" or request.get("method", "POST") != "POST":
+            raise ValueError(f"unsupported url: {request.get('method')} {request.get('url')}")
+        # 批处理没有流式
+        data = dict(request["body"], stream=False)
+        async with semaphore:
+            completion = await openai_stream(data=data, path="/v1/chat/completions", channel="openai")
+        result["response"] = {"status_code": 200, "request_id": completion.get("id"), "body": completion}
+    except APIStatusError as e:
+        result["response"] = {"status_code": e.status_code, "request_id": None, "body": e.body}
+    except Exception as e:
+        result["error"] = {"code": type(e).__name__, "message": str(e)}
+    return result
+
+
+async def run_batch(input_path: str, output_path: str, concurrency: int, window: int):
+    """
+    :param concurrency: 同时发往上游的请求数
+    :param window: 已开始但还没写入输出的行数上限，限制内存，并容忍个别慢请求不阻塞后续行
+    """
+    skip = _completed_lines(output_path)
+    if skip:
+        logger.info(f"resume after {skip} completed lines")
+    semaphore = asyncio.Semaphore(concurrency)
+    pending = deque()
+    done = skip
+    failed = 0
+    start = time.monotonic()
+
+    async def write_head():
+        nonlocal done, failed
+        result = await pending.popleft()
+        failed += result["error"] is not None or result["response"]["status_code"] != 200
+        output.write(ujson.dumps(result, ensure_ascii=False) + "\n")
+        done += 1
+        if done % PROGRESS_INTERVAL == 0:
+            output.flush()
+            logger.info(f"{done} lines done, {failed} failed, "
+                        f"{(done - skip) / (time.monotonic() - start):.1f} lines/s")
+
+    with open(input_path, encoding="utf-8") as input_file, open(output_path, "a", encoding="utf-8") as output:
+        for line in itertools.islice(input_file, skip, None):
+            pending.append(asyncio.create_task(_run_line(line, semaphore)))
+            # 按输入顺序写出，已完成的行尽早写出
+            while pending and (len(pending) >= window or pending[0].done()):
+                await write_head()
+        while pending:
+            await write_head()
+    logger.info(f"batch finished: {done} lines, {failed} failed in this run, "
+                f"{time.monotonic() - start:.1f}s")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("input", help="OpenAI Batch API格式的输入JSONL")
+    arg_parser.add_argument("output", help="输出JSONL，已存在时从中断处继续")
+    arg_parser.add_argument("--concurrency", type=int, default=int(os.environ.get("BATCH_CONCURRENCY", 32)),
+                            help="同时发往上游的请求数")
+    arg_parser.add_argument("--window", type=int, default=None,
+                            help="已开始但未写出的行数上限，默认为并发数的4倍")
+    args = arg_parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level=os.environ.get("LOG_LEVEL", "INFO"))
+    asyncio.run(run_batch(args.input, args.output, args.concurrency, args.window or args.concurrency * 4))
+
+
+if __name__ == "__main__":
+    main()
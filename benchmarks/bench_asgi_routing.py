@@ -0,0 +1,146 @@
+"""
+ASGI路由基准：对比纯ASGI的main:app与原先FastAPI + CORSMiddleware + BaseHTTPMiddleware的实现，统计吞吐、首token时间、
+chunk间隔以及代理进程每个请求、每个chunk消耗的CPU时间
+
+python -m benchmarks.bench_asgi_routing [--requests 500] [--concurrency 20] [--output asgi_routing.json]
+
+原先的实现保留在本文件的legacy_app里，业务逻辑与main:app相同，只是入口不同。
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import ujson
+from fastapi import FastAPI, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
+
+from benchmarks.load_test import run_scenario, start_server, wait_ready
+
+APPS = {"middleware": "benchmarks.bench_asgi_routing:legacy_app", "asgi": "main:app"}
+SCENARIOS = ["stream_plain", "stream_tools", "nonstream_tools", "passthrough"]
+
+
+def create_legacy_app() -> FastAPI:
+    """
+    原先的实现：所有请求经过BaseHTTPMiddleware的proxy_middleware
+    """
+    import main
+
+    legacy_app = FastAPI()
+    legacy_app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"],
+                              allow_headers=["*"])
+    legacy_app.add_event_handler("startup", main.startup_event)
+    legacy_app.add_event_handler("shutdown", main.shutdown_event)
+
+    @legacy_app.middleware("http")
+    async def proxy_middleware(request: Request, call_next):
+        method = request.method
+        if method == "POST" and "/v1/chat/completions" == request.url.path:
+            start = time.perf_counter()
+            data = await request.json()
+            labels = main.metrics.request_labels(request.url.path, data)
+            stream_gen = await main.openai_stream(data=data, path=request.url.path, channel="openai")
+            if data.get("stream", False):
+                resp = StreamingResponse(main.metrics.observe_stream(stream_gen, labels, start),
+                                         media_type="text/event-stream")
+            else:
+                resp = Response(ujson.dumps(stream_gen, ensure_ascii=False), status_code=200,
+                                headers={"content-Type": "application/json"})
+                duration = time.perf_counter() - start
+                main.metrics.DOWNSTREAM_TTFB.labels(*labels).observe(duration)
+                main.metrics.REQUEST_DURATION.labels(*labels).observe(duration)
+            resp.headers["Access-Control-Allow-Origin"] = "*"
+            return resp
+        headers = dict(request.headers)
+        has_body = "content-length" in headers or "transfer-encoding" in headers
+        upstream = main.upstream_pool.pick()
+        headers["host"] = headers["x-forwarded-host"] = upstream.host
+        upstream_request = main.upstream_transport.client.build_request(
+            method=method,
+            url=f"{upstream.url}{request.url.path}",
+            headers={k: v for k, v in headers.items() if k.encode() not in main.HOP_BY_HOP_HEADERS},
+            content=request.stream() if has_body else None,
+            params=request.query_params
+        )
+        response = await main.upstream_transport.client.send(upstream_request, stream=True)
+        return StreamingResponse(response.aiter_raw(), status_code=response.status_code,
+                                 headers={k: v for k, v in response.headers.items()
+                                          if k.encode() not in main.HOP_BY_HOP_HEADERS},
+                                 background=BackgroundTask(response.aclose))
+
+    return legacy_app
+
+
+def _cpu_seconds(pid: int) -> float:
+    """
+    进程累计的用户态与内核态CPU时间（Linux）
+    """
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def bench_app(name: str, args) -> dict:
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    proxy_url = f"http://127.0.0.1:{args.proxy_port}"
+    env = dict(os.environ, LOG_LEVEL="INFO")
+    mock = start_server("benchmarks.mock_upstream:app", args.mock_port, env)
+    proxy = start_server(APPS[name], args.proxy_port,
+                         dict(env, OPENAI_BASE_URL=f"{mock_url}/v1", OPENAI_API_KEY="mock"))
+    results = {}
+    try:
+        await wait_ready(mock_url)
+        await wait_ready(proxy_url)
+        for scenario in args.scenarios:
+            # 预热
+            await run_scenario(proxy_url, scenario, args.concurrency, args.concurrency)
+            cpu = _cpu_seconds(proxy.pid)
+            result = await run_scenario(proxy_url, scenario, args.requests, args.concurrency)
+            cpu = _cpu_seconds(proxy.pid) - cpu
+            chunks = result["chunks_per_s"] * result["duration_s"]
+            result["proxy_cpu_ms_per_request"] = round(cpu * 1000 / args.requests, 3)
+            result["proxy_cpu_us_per_chunk"] = round(cpu * 1e6 / chunks, 3) if chunks else None
+            results[scenario] = result
+            print(f"{name:>10} {scenario:>16}: {result['throughput_rps']:>8} rps, "
+                  f"ttft p50 {result['ttft_p50_ms']} ms, e2e p50 {result['e2e_p50_ms']} ms, "
+                  f"cpu {result['proxy_cpu_ms_per_request']} ms/request, "
+                  f"{result['proxy_cpu_us_per_chunk']} us/chunk, errors {result['errors']}")
+    finally:
+        proxy.terminate()
+        mock.terminate()
+        proxy.wait()
+        mock.wait()
+    return results
+
+
+async def main_async(args):
+    results = {name: await bench_app(name, args) for name in APPS}
+    if args.output:
+        with open(args.output, "w") as f:
+            ujson.dump(results, f, indent=2)
+        print(f"results written to {args.output}")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--requests", type=int, default=500, help="每个场景的请求数")
+    arg_parser.add_argument("--concurrency", type=int, default=20)
+    arg_parser.add_argument("--mock-port", type=int, default=9000)
+    arg_parser.add_argument("--proxy-port", type=int, default=9001)
+    arg_parser.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS)
+    arg_parser.add_argument("--output", default=None, help="结果JSON文件")
+    asyncio.run(main_async(arg_parser.parse_args()))
+
+
+def __getattr__(name: str):
+    # uvicorn加载legacy_app时才导入main，main导入时需要OPENAI_BASE_URL
+    if name == "legacy_app":
+        return create_legacy_app()
+    raise AttributeError(name)
+
+
+if __name__ == "__main__":
+    main()
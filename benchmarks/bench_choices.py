@@ -0,0 +1,158 @@
+"""
+n>1基准：一个n个choice的工具调用请求与n个单choice请求对比，并校验流式与非流式响应中每个choice的工具调用
+
+python -m benchmarks.bench_choices [--n 4] [--requests 50] [--concurrency 10] [--output choices.json]
+
+模拟上游按vLLM的方式交错输出各choice的chunk，各choice的参数长度不同，因而在不同的时刻结束。
+"""
+import argparse
+import asyncio
+import os
+import time
+from typing import Dict, List
+
+import httpx
+import ujson
+
+from benchmarks.load_test import MESSAGES, TOOLS, _ms, _percentile, start_server, wait_ready
+from utilities.completion_accumulator import ChatCompletionAccumulator
+
+
+async def _request(client: httpx.AsyncClient, proxy_url: str, n: int, stream: bool) -> Dict:
+    """
+    发出一个请求，流式响应拼装成完整响应体，并记录各chunk的choice序号
+    """
+    body = {"model": "mock", "messages": MESSAGES, "tools": TOOLS, "n": n, "stream": stream}
+    if not stream:
+        response = await client.post(f"{proxy_url}/v1/chat/completions", json=body)
+        response.raise_for_status()
+        return response.json()
+    accumulator = ChatCompletionAccumulator()
+    indices = []
+    async with client.stream("POST", f"{proxy_url}/v1/chat/completions", json=body) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if line.startswith("data: {"):
+                chunk = ujson.loads(line[6:])
+                indices += [choice["index"] for choice in chunk["choices"]]
+                accumulator.add_chunk(chunk)
+    completion = accumulator.completion()
+    completion["chunk_indices"] = indices
+    return completion
+
+
+def check_completion(completion: Dict, n: int, tool_calls: int, stream: bool) -> List[str]:
+    """
+    校验每个choice：序号齐全、以tool_calls结束、工具调用数量正确、参数是该choice自己的JSON
+
+    :return: 问题列表，为空表示通过
+    """
+    problems = []
+    choices = completion["choices"]
+    if sorted(choice["index"] for choice in choices) != list(range(n)):
+        problems.append(f"choice indices {[choice['index'] for choice in choices]}")
+    for choice in choices:
+        message = choice["message"]
+        if choice["finish_reason"] != "tool_calls":
+            problems.append(f"choice {choice['index']} finish_reason {choice['finish_reason']}")
+        if len(message.get("tool_calls") or []) != tool_calls:
+            problems.append(f"choice {choice['index']} has {len(message.get('tool_calls') or [])} tool calls")
+        for tool_call in message.get("tool_calls") or []:
+            try:
+                arguments = ujson.loads(tool_call["function"]["arguments"])
+            except ValueError:
+                problems.append(f"choice {choice['index']} invalid arguments")
+                continue
+            if arguments.get("choice") != choice["index"]:
+                problems.append(f"choice {choice['index']} got arguments of choice {arguments.get('choice')}")
+    if stream and n > 1:
+        indices = completion["chunk_indices"]
+        # 交错到达：某个choice的chunk之间夹着其他choice的chunk
+        if all(indices[i] <= indices[i + 1] for i in range(len(indices) - 1)):
+            problems.append("choices were not interleaved")
+    return problems
+
+
+async def bench(proxy_url: str, mock_url: str, n: int, per_request_n: int, stream: bool, requests: int,
+                concurrency: int) -> Dict:
+    """
+    requests组候选，每组n个choice：per_request_n为n时每组一个请求，为1时每组n个并发请求
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    async with httpx.AsyncClient(timeout=120) as client:
+        await client.post(f"{mock_url}/mock/reset")
+
+        async def one_set():
+            async with semaphore:
+                start = time.perf_counter()
+                await asyncio.gather(*(_request(client, proxy_url, per_request_n, stream)
+                                       for _ in range(n // per_request_n)))
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one_set() for _ in range(requests)))
+        duration = time.perf_counter() - start
+        prefix_stats = (await client.get(f"{mock_url}/mock/prefix_stats")).json()
+    return {"sets": requests,
+            "sets_per_s": round(requests / duration, 2),
+            "latency_p50_ms": _ms(_percentile(latencies, 0.5)),
+            "latency_p99_ms": _ms(_percentile(latencies, 0.99)),
+            "upstream_requests": prefix_stats["requests"],
+            "upstream_prompt_tokens": prefix_stats["prompt_tokens"]}
+
+
+async def main_async(args):
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    proxy_url = f"http://127.0.0.1:{args.proxy_port}"
+    env = dict(os.environ, LOG_LEVEL="INFO", MOCK_TRACK_PREFIX="1")
+    env.setdefault("MOCK_TOOL_CALLS", "2")
+    tool_calls = int(env["MOCK_TOOL_CALLS"])
+    mock = start_server("benchmarks.mock_upstream:app", args.mock_port, env)
+    proxy = start_server("main:app", args.proxy_port,
+                         dict(env, OPENAI_BASE_URL=f"{mock_url}/v1", OPENAI_API_KEY="mock"))
+    results = {}
+    failed = False
+    try:
+        await wait_ready(mock_url)
+        await wait_ready(proxy_url)
+        async with httpx.AsyncClient(timeout=120) as client:
+            for stream in (True, False):
+                completion = await _request(client, proxy_url, args.n, stream)
+                problems = check_completion(completion, args.n, tool_calls, stream)
+                failed = failed or bool(problems)
+                print(f"{'stream' if stream else 'non-stream':>10} n={args.n}: "
+                      f"{'ok' if not problems else '; '.join(problems)}")
+        for stream in (True, False):
+            mode = "stream" if stream else "nonstream"
+            for per_request_n in sorted({args.n, 1}, reverse=True):
+                name = f"{mode}_n{per_request_n}"
+                results[name] = await bench(proxy_url, mock_url, args.n, per_request_n, stream, args.requests,
+                                            args.concurrency)
+                print(f"{name:>14}: {results[name]}")
+    finally:
+        proxy.terminate()
+        mock.terminate()
+        proxy.wait()
+        mock.wait()
+    if args.output:
+        with open(args.output, "w") as f:
+            ujson.dump(results, f, indent=2)
+        print(f"results written to {args.output}")
+    if failed:
+        raise SystemExit(1)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--n", type=int, default=4, help="每组候选的choice数")
+    arg_parser.add_argument("--requests", type=int, default=50, help="每种方式的候选组数")
+    arg_parser.add_argument("--concurrency", type=int, default=10)
+    arg_parser.add_argument("--mock-port", type=int, default=9000)
+    arg_parser.add_argument("--proxy-port", type=int, default=9001)
+    arg_parser.add_argument("--output", default=None, help="结果JSON文件")
+    asyncio.run(main_async(arg_parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
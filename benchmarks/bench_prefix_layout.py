@@ -0,0 +1,89 @@
+"""
+工具提示词布局的前缀缓存基准：在多轮工具调用对话中，统计模拟上游收到的prompt与历史prompt共享的前缀token数
+
+python -m benchmarks.bench_prefix_layout [--turns 6] [--output prefix_layout.json]
+"""
+import argparse
+import asyncio
+import os
+
+import httpx
+import ujson
+
+from benchmarks.load_test import TOOLS, start_server, wait_ready
+
+QUESTIONS = ["What's the weather like in San Francisco?",
+             "And in Tokyo?",
+             "Which one is warmer, Paris or Berlin?",
+             "Should I bring an umbrella to London tomorrow?",
+             "What about Sydney this weekend?",
+             "Compare the weather of New York and Boston."]
+
+
+async def run_conversation(proxy_url: str, turns: int):
+    """
+    多轮工具调用对话：每轮用户提问 -> 模型调用工具 -> 提交工具结果 -> 模型回答
+    """
+    messages = []
+    async with httpx.AsyncClient(timeout=60) as client:
+        for turn in range(turns):
+            messages.append({"role": "user", "content": QUESTIONS[turn % len(QUESTIONS)]})
+            response = (await client.post(f"{proxy_url}/v1/chat/completions",
+                                          json={"model": "mock", "messages": messages, "tools": TOOLS})).json()
+            message = response["choices"][0]["message"]
+            messages.append({"role": "assistant", "content": message.get("content"),
+                             "tool_calls": message.get("tool_calls") or []})
+            for tool_call in message.get("tool_calls") or []:
+                messages.append({"role": "tool", "tool_call_id": tool_call["id"],
+                                 "name": tool_call["function"]["name"],
+                                 "content": ujson.dumps({"temperature": 20, "unit": "celsius"})})
+            response = (await client.post(f"{proxy_url}/v1/chat/completions",
+                                          json={"model": "mock", "messages": messages, "tools": TOOLS})).json()
+            messages.append({"role": "assistant", "content": response["choices"][0]["message"].get("content") or ""})
+
+
+async def bench_layout(layout: str, args) -> dict:
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    proxy_url = f"http://127.0.0.1:{args.proxy_port}"
+    env = dict(os.environ, MOCK_TRACK_PREFIX="1")
+    mock = start_server("benchmarks.mock_upstream:app", args.mock_port, env)
+    proxy = start_server("main:app", args.proxy_port,
+                         dict(env, OPENAI_BASE_URL=f"{mock_url}/v1", OPENAI_API_KEY="mock", TOOL_PROMPT_LAYOUT=layout))
+    try:
+        await wait_ready(mock_url)
+        await wait_ready(proxy_url)
+        await run_conversation(proxy_url, args.turns)
+        async with httpx.AsyncClient() as client:
+            stats = (await client.get(f"{mock_url}/mock/prefix_stats")).json()
+    finally:
+        proxy.terminate()
+        mock.terminate()
+        proxy.wait()
+        mock.wait()
+    return stats
+
+
+async def main_async(args):
+    results = {}
+    for layout in ("user", "prefix"):
+        stats = await bench_layout(layout, args)
+        results[layout] = stats
+        print(f"{layout:>8}: {stats['requests']} requests, prompt tokens {stats['prompt_tokens']}, "
+              f"shared prefix tokens {stats['shared_prefix_tokens']} ({stats['shared_ratio']:.1%}), "
+              f"prefill tokens after prefix caching {stats['prefill_tokens']}")
+    if args.output:
+        with open(args.output, "w") as f:
+            ujson.dump(results, f, indent=2)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--turns", type=int, default=6, help="对话轮数")
+    arg_parser.add_argument("--mock-port", type=int, default=9000)
+    arg_parser.add_argument("--proxy-port", type=int, default=9001)
+    arg_parser.add_argument("--output", default=None, help="结果JSON文件")
+    asyncio.run(main_async(arg_parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
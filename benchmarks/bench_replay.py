@@ -0,0 +1,188 @@
+"""
+录制回放基准：用录制的上游响应（utilities.sse_transcript）重跑请求，不依赖上游，chunk切分与录制时逐字节相同
+
+录制（生产环境设置SSE_RECORD_DIR即可，这里用模拟上游录一组）：
+python -m benchmarks.bench_replay record --dir transcripts [--requests 50]
+
+回放，--speed 0为不等待，测量代理每个请求、每个上游chunk的CPU时间；1为录制时的节奏，测量延迟：
+python -m benchmarks.bench_replay replay --dir transcripts [--speed 0] [--repeat 5] [--output replay.json]
+    [--expect replay_baseline.json]
+
+回放时记录每个请求响应的摘要（内容、工具调用与finish_reason），--expect给出之前的结果文件时比较摘要，转换结果有变化的
+请求数记为changed。
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import time
+from typing import Dict, List
+
+import httpx
+import ujson
+
+from benchmarks.bench_asgi_routing import _cpu_seconds
+from benchmarks.load_test import SCENARIOS, _ms, _percentile, run_scenario, start_server, wait_ready
+from utilities.completion_accumulator import ChatCompletionAccumulator
+from utilities.sse_transcript import load_transcripts, transcript_body
+
+RECORD_SCENARIOS = ["stream_tools", "nonstream_tools", "stream_plain"]
+
+
+async def record(args):
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    proxy_url = f"http://127.0.0.1:{args.proxy_port}"
+    env = dict(os.environ, LOG_LEVEL="INFO")
+    mock = start_server("benchmarks.mock_upstream:app", args.mock_port, env)
+    proxy = start_server("main:app", args.proxy_port,
+                         dict(env, OPENAI_BASE_URL=f"{mock_url}/v1", OPENAI_API_KEY="mock",
+                              SSE_RECORD_DIR=args.dir))
+    try:
+        await wait_ready(mock_url)
+        await wait_ready(proxy_url)
+        for scenario in args.scenarios:
+            result = await run_scenario(proxy_url, scenario, args.requests, args.concurrency)
+            print(f"recorded {scenario:>16}: {args.requests} requests, errors {result['errors']}")
+    finally:
+        # 代理正常退出时写完剩余的录制
+        proxy.terminate()
+        mock.terminate()
+        proxy.wait()
+        mock.wait()
+    print(f"{len(load_transcripts(args.dir))} transcripts in {args.dir}")
+
+
+def _digest(completion: Dict) -> str:
+    """
+    响应的摘要：各choice的内容、工具调用与finish_reason，不含每次随机生成的id
+    """
+    choices = [[choice["index"], choice["message"].get("content"), choice["finish_reason"],
+                [[tool_call["function"]["name"], tool_call["function"]["arguments"]]
+                 for tool_call in choice["message"].get("tool_calls") or []]]
+               for choice in sorted(completion["choices"], key=lambda choice: choice["index"])]
+    return hashlib.sha256(ujson.dumps(choices, ensure_ascii=False).encode()).hexdigest()[:16]
+
+
+async def _replay_one(client: httpx.AsyncClient, proxy_url: str, request: Dict, result: Dict, key: str):
+    start = time.perf_counter()
+    first = None
+    try:
+        if request.get("stream"):
+            accumulator = ChatCompletionAccumulator()
+            async with client.stream("POST", f"{proxy_url}/v1/chat/completions", json=request) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if first is None:
+                        first = time.perf_counter()
+                    if line.startswith("data: {"):
+                        accumulator.add_chunk(ujson.loads(line[6:]))
+            completion = accumulator.completion()
+        else:
+            response = await client.post(f"{proxy_url}/v1/chat/completions", json=request)
+            response.raise_for_status()
+            completion = response.json()
+    except httpx.HTTPError:
+        result["errors"] += 1
+        return
+    end = time.perf_counter()
+    result["ttft"].append((first or end) - start)
+    result["e2e"].append(end - start)
+    digest = _digest(completion)
+    if result["digests"].setdefault(key, digest) != digest:
+        result["unstable"].add(key)
+
+
+async def replay(args):
+    transcripts = load_transcripts(args.dir)
+    # 同一客户端请求的多条录制（对冲、故障转移、追问）只回放一次请求
+    requests: Dict[str, Dict] = {}
+    upstream_chunks: Dict[str, int] = {}
+    for transcript in transcripts:
+        if transcript["request_key"] not in requests:
+            requests[transcript["request_key"]] = transcript["request"]
+            upstream_chunks[transcript["request_key"]] = transcript_body(transcript).count(b"data: ")
+    if not requests:
+        raise SystemExit(f"no transcripts in {args.dir}")
+    proxy_url = f"http://127.0.0.1:{args.proxy_port}"
+    # 回放时不连接上游，地址只用于拼接请求
+    proxy = start_server("main:app", args.proxy_port,
+                         dict(os.environ, LOG_LEVEL="INFO", OPENAI_BASE_URL="http://replay.invalid/v1",
+                              OPENAI_API_KEY="replay", SSE_REPLAY_PATH=args.dir, SSE_REPLAY_SPEED=str(args.speed)))
+    result = {"ttft": [], "e2e": [], "errors": 0, "digests": {}, "unstable": set()}
+    try:
+        await wait_ready(proxy_url)
+        semaphore = asyncio.Semaphore(args.concurrency)
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(120)) as client:
+            async def worker(key: str):
+                async with semaphore:
+                    await _replay_one(client, proxy_url, requests[key], result, key)
+
+            keys: List[str] = list(requests) * args.repeat
+            cpu = _cpu_seconds(proxy.pid)
+            start = time.perf_counter()
+            await asyncio.gather(*(worker(key) for key in keys))
+            duration = time.perf_counter() - start
+            cpu = _cpu_seconds(proxy.pid) - cpu
+            transport_stats = (await client.get(f"{proxy_url}/proxy/transport/stats")).json()
+    finally:
+        proxy.terminate()
+        proxy.wait()
+
+    chunks = sum(upstream_chunks[key] for key in keys)
+    report = {"requests": len(keys),
+              "distinct_requests": len(requests),
+              "speed": args.speed,
+              "errors": result["errors"],
+              "replay": transport_stats["replay"],
+              "duration_s": round(duration, 3),
+              "throughput_rps": round(len(keys) / duration, 2),
+              "ttft_p50_ms": _ms(_percentile(result["ttft"], 0.5)),
+              "ttft_p99_ms": _ms(_percentile(result["ttft"], 0.99)),
+              "e2e_p50_ms": _ms(_percentile(result["e2e"], 0.5)),
+              "e2e_p99_ms": _ms(_percentile(result["e2e"], 0.99)),
+              "proxy_cpu_ms_per_request": round(cpu * 1000 / len(keys), 3),
+              "proxy_cpu_us_per_upstream_chunk": round(cpu * 1e6 / chunks, 3) if chunks else None,
+              # 同一请求多次回放的结果不一致
+              "unstable": len(result["unstable"]),
+              "digests": result["digests"]}
+    if args.expect:
+        with open(args.expect) as f:
+            expected = ujson.load(f)["digests"]
+        report["changed"] = sum(1 for key, digest in report["digests"].items()
+                                if key in expected and expected[key] != digest)
+    print(ujson.dumps({k: v for k, v in report.items() if k != "digests"}, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            ujson.dump(report, f, indent=2)
+        print(f"results written to {args.output}")
+    if result["errors"] or report["unstable"] or report.get("changed"):
+        raise SystemExit(1)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    sub_parsers = arg_parser.add_subparsers(dest="command", required=True)
+    record_parser = sub_parsers.add_parser("record", help="经模拟上游录制一组请求")
+    record_parser.add_argument("--dir", default="transcripts", help="录制目录")
+    record_parser.add_argument("--requests", type=int, default=50, help="每个场景的请求数")
+    record_parser.add_argument("--concurrency", type=int, default=10)
+    record_parser.add_argument("--mock-port", type=int, default=9000)
+    record_parser.add_argument("--proxy-port", type=int, default=9001)
+    record_parser.add_argument("--scenarios", nargs="+", default=RECORD_SCENARIOS,
+                               choices=[name for name, scenario in SCENARIOS.items()
+                                        if scenario[1] == "/v1/chat/completions"])
+    replay_parser = sub_parsers.add_parser("replay", help="回放录制")
+    replay_parser.add_argument("--dir", default="transcripts", help="录制文件或目录")
+    replay_parser.add_argument("--speed", type=float, default=0, help="回放速度，0为不等待，1为录制时的节奏")
+    replay_parser.add_argument("--repeat", type=int, default=5, help="每个请求的回放次数")
+    replay_parser.add_argument("--concurrency", type=int, default=10)
+    replay_parser.add_argument("--proxy-port", type=int, default=9001)
+    replay_parser.add_argument("--output", default=None, help="结果JSON文件")
+    replay_parser.add_argument("--expect", default=None, help="之前的结果JSON文件，比较响应摘要")
+    args = arg_parser.parse_args()
+    asyncio.run(record(args) if args.command == "record" else replay(args))
+
+
+if __name__ == "__main__":
+    main()
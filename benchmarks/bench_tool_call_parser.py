@@ -0,0 +1,100 @@
+"""
+工具调用流式解析的微基准：逐字符累积的旧循环 vs ToolCallStreamParser
+
+python -m benchmarks.bench_tool_call_parser [--chunk-size 4] [--repeat 5]
+"""
+import argparse
+import time
+
+import ujson
+
+from utilities.tool_call_parser import ToolCallStreamParser, TOOL_CALL, ARGUMENTS
+
+
+def legacy_parse(deltas):
+    """
+    旧版_tool_calling_transfer_to_openai中工具调用期的逐字符解析，只保留解析部分
+    """
+    tool_calls = []
+    tool_calling_period = False
+    tool_calling_cache = ""
+    mark_inx = None
+    for content in deltas:
+        if not tool_calling_period:
+            if '✿' in content:
+                tool_calling_period = True
+                tool_calling_cache = content[content.find("✿"):]
+            continue
+        for c in content:
+            tool_calling_cache = ''.join([tool_calling_cache, c])
+            if mark_inx is None:
+                mark_inx = tool_calling_cache.find("✿✿\n")
+                if mark_inx >= 0:
+                    tool_calling_cache = tool_calling_cache[mark_inx + 3:]
+                else:
+                    mark_inx = None
+            elif "<name>" in tool_calling_cache and tool_calling_cache.endswith("</name>"):
+                name_trunk_he = tool_calling_cache.find("<name>")
+                name_trunk_ta = tool_calling_cache.find("</name>")
+                tool_calls.append([tool_calling_cache[name_trunk_he + 6:name_trunk_ta], ""])
+                tool_calling_cache = tool_calling_cache[name_trunk_ta + 7:]
+            elif "<arguments>" in tool_calling_cache and tool_calling_cache.endswith("</arguments>"):
+                arguments_trunk_he, arguments_trunk_ta = (
+                    tool_calling_cache.find("<arguments>"), tool_calling_cache.find("</arguments>"))
+                tool_calls[-1][1] = tool_calling_cache[arguments_trunk_he + 11:arguments_trunk_ta]
+                tool_calling_cache = tool_calling_cache[arguments_trunk_ta + 12:]
+    return tool_calls
+
+
+def parser_parse(deltas):
+    """
+    ToolCallStreamParser解析
+    """
+    tool_calls = []
+    parser = ToolCallStreamParser()
+    for content in deltas:
+        for event in parser.feed(content):
+            if event[0] == TOOL_CALL:
+                tool_calls.append([event[2], []])
+            elif event[0] == ARGUMENTS:
+                tool_calls[event[1]][1].append(event[2])
+    return [[name, ''.join(args)] for name, args in tool_calls]
+
+
+def build_deltas(args_size: int, tool_call_num: int, chunk_size: int):
+    """
+    构造模型输出：一句普通回复加上若干个参数约为args_size字节的工具调用，再按chunk_size切分
+    """
+    payload = ujson.dumps({"query": "x" * args_size, "top_k": 10}, ensure_ascii=False)
+    text = "稍等，我将为你查询...\n✿✿\n" + "".join(
+        f"<name>search</name>\n<arguments>{payload}</arguments>\n" for _ in range(tool_call_num))
+    return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+
+def bench(func, deltas, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(deltas)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--chunk-size", type=int, default=4, help="每个delta的字符数")
+    arg_parser.add_argument("--tool-calls", type=int, default=3, help="工具调用数量")
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    args = arg_parser.parse_args()
+
+    print(f"{'args size':>10} {'legacy ms':>12} {'parser ms':>12} {'speedup':>10}")
+    for args_size in (1024, 4096, 16384, 65536):
+        deltas = build_deltas(args_size, args.tool_calls, args.chunk_size)
+        assert legacy_parse(deltas) == parser_parse(deltas)
+        legacy = bench(legacy_parse, deltas, args.repeat)
+        parser = bench(parser_parse, deltas, args.repeat)
+        print(f"{args_size:>10} {legacy * 1000:>12.2f} {parser * 1000:>12.2f} {legacy / parser:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
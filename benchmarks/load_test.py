@@ -0,0 +1,202 @@
+"""
+代理压测：启动模拟上游与代理，分别直连上游和经过代理发压，统计吞吐、首token时间、chunk间隔及代理引入的开销
+
+python -m benchmarks.load_test [--requests 200] [--concurrency 20] [--output load_test.json]
+
+模拟上游的行为由MOCK_*环境变量控制，见benchmarks/mock_upstream.py。
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+import httpx
+import ujson
+
+TOOLS = [{
+    "type": "function",
+    "function": {
+        "name": "get_current_weather",
+        "description": "Get the current weather in a given location",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "location": {"type": "string", "description": "The city and state, e.g. San Francisco"},
+                "unit": {"type": "string", "enum": ["celsius", "fahrenheit"]},
+            },
+            "required": ["location"],
+        },
+    },
+}]
+MESSAGES = [{"role": "user", "content": "What's the weather like in San Francisco, Tokyo, and Paris?"}]
+
+# 场景：名称 -> (方法, 路径, 请求体, 是否流式)
+SCENARIOS = {
+    "stream_tools": ("POST", "/v1/chat/completions",
+                     {"model": "mock", "messages": MESSAGES, "tools": TOOLS, "stream": True}, True),
+    "nonstream_tools": ("POST", "/v1/chat/completions",
+                        {"model": "mock", "messages": MESSAGES, "tools": TOOLS}, False),
+    "stream_plain": ("POST", "/v1/chat/completions",
+                     {"model": "mock", "messages": MESSAGES, "stream": True}, True),
+    "passthrough": ("POST", "/v1/embeddings",
+                    {"model": "mock", "input": ["hello world"] * 8}, False),
+}
+
+
+def _percentile(values: List[float], p: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def _ms(seconds: float | None) -> float | None:
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+async def _one_request(client: httpx.AsyncClient, base_url: str, scenario: str, result: Dict):
+    method, path, body, _ = SCENARIOS[scenario]
+    start = time.perf_counter()
+    first = last = None
+    try:
+        async with client.stream(method, base_url + path, json=body) as response:
+            async for chunk in response.aiter_raw():
+                if not chunk:
+                    continue
+                now = time.perf_counter()
+                if first is None:
+                    first = now
+                else:
+                    result["gaps"].append(now - last)
+                last = now
+                result["bytes"] += len(chunk)
+                result["chunks"] += 1
+            if response.status_code >= 400:
+                result["errors"] += 1
+                return
+    except httpx.HTTPError:
+        result["errors"] += 1
+        return
+    end = time.perf_counter()
+    result["ttft"].append((first or end) - start)
+    result["e2e"].append(end - start)
+
+
+async def run_scenario(base_url: str, scenario: str, requests: int, concurrency: int) -> Dict:
+    """
+    对base_url以固定并发发送requests个请求
+    """
+    result = {"ttft": [], "e2e": [], "gaps": [], "errors": 0, "bytes": 0, "chunks": 0}
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(120)) as client:
+        async def worker():
+            async with semaphore:
+                await _one_request(client, base_url, scenario, result)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(requests)))
+        duration = time.perf_counter() - start
+
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": result["errors"],
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(requests / duration, 2),
+        "chunks_per_s": round(result["chunks"] / duration, 2),
+        "bytes_per_s": round(result["bytes"] / duration, 2),
+        "ttft_p50_ms": _ms(_percentile(result["ttft"], 0.5)),
+        "ttft_p99_ms": _ms(_percentile(result["ttft"], 0.99)),
+        "inter_chunk_p50_ms": _ms(_percentile(result["gaps"], 0.5)),
+        "inter_chunk_p99_ms": _ms(_percentile(result["gaps"], 0.99)),
+        "inter_chunk_mean_ms": _ms(statistics.fmean(result["gaps"]) if result["gaps"] else None),
+        "e2e_p50_ms": _ms(_percentile(result["e2e"], 0.5)),
+        "e2e_p99_ms": _ms(_percentile(result["e2e"], 0.99)),
+    }
+
+
+def _overhead(proxy: Dict, direct: Dict) -> Dict:
+    """
+    代理相对直连上游的开销
+    """
+    overhead = {}
+    for key in ("ttft_p50_ms", "ttft_p99_ms", "e2e_p50_ms", "e2e_p99_ms"):
+        if proxy[key] is not None and direct[key] is not None:
+            overhead[key] = round(proxy[key] - direct[key], 3)
+    return overhead
+
+
+def start_server(app: str, port: int, env: Dict, workers: int = 1) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning", "--no-access-log"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_ready(base_url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(base_url + "/v1/models")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise TimeoutError(f"{base_url} not ready")
+
+
+async def main_async(args):
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    proxy_url = f"http://127.0.0.1:{args.proxy_port}"
+    env = dict(os.environ, LOG_LEVEL="INFO")
+    mock = start_server("benchmarks.mock_upstream:app", args.mock_port, env)
+    proxy = start_server("main:app", args.proxy_port,
+                         dict(env, OPENAI_BASE_URL=f"{mock_url}/v1", OPENAI_API_KEY="mock"), args.workers)
+    try:
+        await wait_ready(mock_url)
+        await wait_ready(proxy_url)
+        results = {"config": {k: v for k, v in env.items() if k.startswith("MOCK_")} | {
+            "requests": args.requests, "concurrency": args.concurrency, "proxy_workers": args.workers},
+            "scenarios": {}}
+        for scenario in args.scenarios:
+            # 预热
+            await run_scenario(proxy_url, scenario, args.concurrency, args.concurrency)
+            direct = await run_scenario(mock_url, scenario, args.requests, args.concurrency)
+            via_proxy = await run_scenario(proxy_url, scenario, args.requests, args.concurrency)
+            results["scenarios"][scenario] = {"direct": direct, "proxy": via_proxy,
+                                              "overhead": _overhead(via_proxy, direct)}
+            print(f"{scenario:>16}: proxy {via_proxy['throughput_rps']:>8} rps, "
+                  f"ttft p50 {via_proxy['ttft_p50_ms']} ms, p99 {via_proxy['ttft_p99_ms']} ms, "
+                  f"errors {via_proxy['errors']}, overhead {results['scenarios'][scenario]['overhead']}")
+    finally:
+        proxy.terminate()
+        mock.terminate()
+        proxy.wait()
+        mock.wait()
+
+    with open(args.output, "w") as f:
+        ujson.dump(results, f, indent=2)
+    print(f"results written to {args.output}")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--requests", type=int, default=200, help="每个场景的请求数")
+    arg_parser.add_argument("--concurrency", type=int, default=20)
+    arg_parser.add_argument("--workers", type=int, default=1, help="代理的uvicorn worker数")
+    arg_parser.add_argument("--mock-port", type=int, default=9000)
+    arg_parser.add_argument("--proxy-port", type=int, default=9001)
+    arg_parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS))
+    arg_parser.add_argument("--output", default="load_test.json", help="结果JSON文件")
+    asyncio.run(main_async(arg_parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
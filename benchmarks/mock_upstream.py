@@ -0,0 +1,295 @@
+"""
+模拟OpenAI兼容的上游（vLLM），用于在没有GPU的情况下压测本代理
+
+MOCK_TOKEN_RATE=200 MOCK_CHUNK_TOKENS=1 uvicorn benchmarks.mock_upstream:app --port 9000
+
+环境变量：
+    MOCK_TOKEN_RATE：每秒生成的token数，0表示不限速
+    MOCK_CHUNK_TOKENS：每个SSE chunk包含的token数
+    MOCK_OUTPUT_TOKENS：普通回复的token数
+    MOCK_ARGS_SIZE：工具调用参数JSON的大致字节数
+    MOCK_TOOL_CALLS：每次回复的工具调用数量
+    MOCK_LATENCY：首token延迟（秒）
+    MOCK_JITTER：延迟抖动比例，例如0.2表示±20%
+    MOCK_SLOW_RATE：首token特别慢的请求比例，模拟prefill卡顿
+    MOCK_SLOW_LATENCY：慢请求额外的首token延迟（秒）
+    MOCK_TRAILING_TOKENS：工具调用块之后继续输出的无关内容token数，用于观察代理提前结束上游生成
+    MOCK_TRACK_PREFIX：设为1时记录每个请求与历史请求共享的前缀token数，见/mock/prefix_stats
+    MOCK_BAD_ARGS：工具调用参数的错误，trailing_comma为多余的尾逗号（可本地修复），missing_query为缺少query参数
+        （需要追问），追问时回复正确的参数
+"""
+import asyncio
+import os
+import random
+import re
+import time
+import uuid
+from collections import deque
+from typing import Dict
+
+import ujson
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse, Response
+
+from utilities.dialects import select_dialect
+from utilities.tool_validation import REASK_PROMPT
+
+# 每个token的字符数
+TOKEN_CHARS = 3
+# 前缀缓存的块大小（token），与vLLM一致
+PREFIX_BLOCK_TOKENS = 16
+
+
+class MockConfig:
+    """
+    模拟上游的配置
+    """
+
+    def __init__(self,
+                 token_rate: float = float(os.environ.get("MOCK_TOKEN_RATE", 0)),
+                 chunk_tokens: int = int(os.environ.get("MOCK_CHUNK_TOKENS", 1)),
+                 output_tokens: int = int(os.environ.get("MOCK_OUTPUT_TOKENS", 64)),
+                 args_size: int = int(os.environ.get("MOCK_ARGS_SIZE", 256)),
+                 tool_calls: int = int(os.environ.get("MOCK_TOOL_CALLS", 1)),
+                 latency: float = float(os.environ.get("MOCK_LATENCY", 0)),
+                 jitter: float = float(os.environ.get("MOCK_JITTER", 0)),
+                 trailing_tokens: int = int(os.environ.get("MOCK_TRAILING_TOKENS", 0)),
+                 slow_rate: float = float(os.environ.get("MOCK_SLOW_RATE", 0)),
+                 slow_latency: float = float(os.environ.get("MOCK_SLOW_LATENCY", 0)),
+                 track_prefix: bool = os.environ.get("MOCK_TRACK_PREFIX") == "1",
+                 bad_args: str = os.environ.get("MOCK_BAD_ARGS", "")):
+        self.token_rate = token_rate
+        self.chunk_tokens = chunk_tokens
+        self.output_tokens = output_tokens
+        self.args_size = args_size
+        self.tool_calls = tool_calls
+        self.latency = latency
+        self.jitter = jitter
+        self.trailing_tokens = trailing_tokens
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.track_prefix = track_prefix
+        self.bad_args = bad_args
+
+    def delay(self, seconds: float) -> float:
+        """
+        加上抖动的延迟
+        """
+        if not seconds:
+            return 0
+        return max(0., seconds * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def first_token_delay(self) -> float:
+        """
+        首token延迟，按MOCK_SLOW_RATE的比例加上MOCK_SLOW_LATENCY
+        """
+        slow = self.slow_latency if self.slow_rate and random.random() < self.slow_rate else 0.
+        return self.delay(self.latency) + slow
+
+
+def _wants_tool_call(data: Dict) -> bool:
+    """
+    请求是否带工具：OpenAI格式的tools，或者经本代理按方言改写后的工具定义提示词
+    """
+    if data.get("tools"):
+        return True
+    tools_mark = select_dialect(data.get("model")).tools_mark
+    return any(tools_mark in (message.get("content") or "") for message in data.get("messages", []))
+
+
+def _is_reask(data: Dict) -> bool:
+    """
+    是否是代理对不合法参数的追问
+    """
+    messages = data.get("messages") or [{}]
+    return REASK_PROMPT.rsplit("\n", 1)[-1] in (messages[-1].get("content") or "")
+
+
+def _tool_name(data: Dict) -> str:
+    """
+    从请求中找出一个函数名
+    """
+    if data.get("tools"):
+        return data["tools"][0]["function"]["name"]
+    for message in reversed(data.get("messages", [])):
+        name = re.search(r'"name":\s*"([^"]+)"', message.get("content") or "")
+        if name:
+            return name.group(1)
+    return "mock_tool"
+
+
+def build_output(data: Dict, config: MockConfig, index: int = 0) -> str:
+    """
+    构造模型输出文本：带工具的请求按model对应的方言输出工具调用，否则输出普通回复
+
+    :param index: choice序号，n>1时各choice的参数长度不同，因而在不同的时刻结束
+    """
+    args = ujson.dumps({"choice": index, "query": "x" * (config.args_size + 16 * index)}, ensure_ascii=False)
+    if _is_reask(data):
+        return args
+    if _wants_tool_call(data):
+        name = _tool_name(data)
+        if config.bad_args == "trailing_comma":
+            args = args[:-1] + ",}"
+        elif config.bad_args == "missing_query":
+            args = ujson.dumps({"choice": index})
+        return "稍等，我将调用工具...\n" + select_dialect(data.get("model")).format_tool_calls(
+            [(name, args)] * config.tool_calls) + \
+            ("以上是工具调用。" * config.trailing_tokens)[:config.trailing_tokens * TOKEN_CHARS]
+    return ("这是一段模拟回复。" * config.output_tokens)[:config.output_tokens * TOKEN_CHARS]
+
+
+def render_prompt(data: Dict) -> str:
+    """
+    按Qwen2的chat模板把messages渲染成prompt
+    """
+    return "".join(f"<|im_start|>{message['role']}\n{message.get('content') or ''}<|im_end|>\n"
+                   for message in data.get("messages", [])) + "<|im_start|>assistant\n"
+
+
+class PrefixTracker:
+    """
+    模拟vLLM的自动前缀缓存：统计每个prompt与历史prompt共享的最长前缀
+    """
+
+    def __init__(self, history: int = 256):
+        self._prompts = deque(maxlen=history)
+        self.records = []
+
+    def add(self, prompt: str):
+        shared = max((len(os.path.commonprefix([prompt, history])) for history in self._prompts), default=0)
+        self._prompts.append(prompt)
+        shared_tokens = shared // TOKEN_CHARS
+        self.records.append({"prompt_tokens": len(prompt) // TOKEN_CHARS,
+                             "shared_prefix_tokens": shared_tokens,
+                             "cached_block_tokens": shared_tokens // PREFIX_BLOCK_TOKENS * PREFIX_BLOCK_TOKENS})
+
+    def stats(self) -> Dict:
+        prompt_tokens = sum(record["prompt_tokens"] for record in self.records)
+        shared_tokens = sum(record["shared_prefix_tokens"] for record in self.records)
+        cached_tokens = sum(record["cached_block_tokens"] for record in self.records)
+        return {"requests": len(self.records),
+                "prompt_tokens": prompt_tokens,
+                "shared_prefix_tokens": shared_tokens,
+                "cached_block_tokens": cached_tokens,
+                # 需要重新prefill的token数
+                "prefill_tokens": prompt_tokens - cached_tokens,
+                "shared_ratio": shared_tokens / prompt_tokens if prompt_tokens else 0.,
+                "per_request": self.records}
+
+
+def create_app(config: MockConfig | None = None) -> FastAPI:
+    config = config or MockConfig()
+    mock_app = FastAPI()
+    prefix_tracker = PrefixTracker()
+    # 流式请求统计：completed为完整生成，aborted为客户端中途断开，chunks为实际发出的内容chunk数
+    stream_stats = {"completed": 0, "aborted": 0, "chunks": 0}
+
+    @mock_app.get("/mock/stream_stats")
+    async def get_stream_stats():
+        return stream_stats
+
+    @mock_app.get("/mock/prefix_stats")
+    async def prefix_stats():
+        return prefix_tracker.stats()
+
+    @mock_app.post("/mock/reset")
+    async def reset():
+        nonlocal prefix_tracker
+        prefix_tracker = PrefixTracker()
+        stream_stats.update(completed=0, aborted=0, chunks=0)
+        return {}
+
+    @mock_app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]}
+
+    @mock_app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        data = await request.json()
+        inputs = data.get("input", [])
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        return {"object": "list",
+                "data": [{"object": "embedding", "index": i, "embedding": [0.1] * 1024} for i in range(len(inputs))],
+                "model": data.get("model", "mock"),
+                "usage": {"prompt_tokens": 0, "total_tokens": 0}}
+
+    @mock_app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        data = await request.json()
+        if config.track_prefix:
+            prefix_tracker.add(render_prompt(data))
+        outputs = [build_output(data, config, index) for index in range(data.get("n") or 1)]
+        completion_id = f"cmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        model = data.get("model", "mock")
+        await asyncio.sleep(config.first_token_delay())
+
+        if not data.get("stream"):
+            if config.token_rate:
+                await asyncio.sleep(config.delay(max(map(len, outputs)) / TOKEN_CHARS / config.token_rate))
+            return Response(ujson.dumps({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": index,
+                             "message": {"role": "assistant", "content": output},
+                             "logprobs": None,
+                             "finish_reason": "stop"} for index, output in enumerate(outputs)],
+                "usage": {"prompt_tokens": 0, "completion_tokens": sum(map(len, outputs)) // TOKEN_CHARS,
+                          "total_tokens": sum(map(len, outputs)) // TOKEN_CHARS}}, ensure_ascii=False),
+                media_type="application/json")
+
+        async def sse():
+            def chunk(delta: Dict, finish_reason: str | None = None, index: int = 0) -> str:
+                return "data: " + ujson.dumps({"id": completion_id,
+                                               "object": "chat.completion.chunk",
+                                               "created": created,
+                                               "model": model,
+                                               "choices": [{"index": index,
+                                                            "delta": delta,
+                                                            "logprobs": None,
+                                                            "finish_reason": finish_reason}]},
+                                              ensure_ascii=False) + "\n\n"
+
+            for index in range(len(outputs)):
+                yield chunk({"role": "assistant"}, index=index)
+            step = TOKEN_CHARS * config.chunk_tokens
+            try:
+                # 与vLLM一样，n>1时各choice的chunk交错输出，每个chunk只含一个choice
+                for i in range(0, max(map(len, outputs)), step):
+                    if config.token_rate:
+                        await asyncio.sleep(config.delay(config.chunk_tokens / config.token_rate))
+                    for index, output in enumerate(outputs):
+                        if i < len(output):
+                            stream_stats["chunks"] += 1
+                            yield chunk({"content": output[i:i + step]}, index=index)
+                            if i + step >= len(output):
+                                yield chunk({}, "stop", index)
+            except (GeneratorExit, asyncio.CancelledError):
+                stream_stats["aborted"] += 1
+                raise
+            stream_stats["completed"] += 1
+            if (data.get("stream_options") or {}).get("include_usage"):
+                completion_tokens = sum(map(len, outputs)) // TOKEN_CHARS
+                yield "data: " + ujson.dumps({"id": completion_id,
+                                              "object": "chat.completion.chunk",
+                                              "created": created,
+                                              "model": model,
+                                              "choices": [],
+                                              "usage": {"prompt_tokens": 0, "completion_tokens": completion_tokens,
+                                                        "total_tokens": completion_tokens}}) + "\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(sse(), media_type="text/event-stream")
+
+    return mock_app
+
+
+app = create_app()
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="127.0.0.1", port=9000)
@@ -1,97 +1,377 @@
+import asyncio
 import os
+import sys
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Tuple
 import ujson
-from fastapi import FastAPI, Request
-from fastapi.responses import StreamingResponse, Response
 import httpx
 from loguru import logger
-from urllib.parse import urlparse
-from fastapi.middleware.cors import CORSMiddleware
-from utilities.openai_tool import openai_stream
+from utilities import metrics
+from utilities.admission import AdmissionController, AdmissionRejected, admission
+from utilities.compaction import context_compactor
+from utilities.hedging import hedger
+from utilities.openai_tool import early_stop_stats, openai_stream
+from utilities.request_log import request_log
+from utilities.response_cache import response_cache
+from utilities.single_flight import single_flight
+from utilities.sse_transcript import sse_recorder
+from utilities.tool_validation import tool_validator
+from utilities.transport import upstream_transport
+from utilities.upstreams import API_KEY, upstream_pool
 
-app = FastAPI()
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # 允许所有来源
-    allow_credentials=True,
-    allow_methods=["*"],  # 允许所有HTTP方法
-    allow_headers=["*"],  # 允许所有HTTP头
-)
+# 日志级别，低于该级别的日志不做格式化，生产环境建议INFO
+logger.remove()
+logger.add(sys.stderr, level=os.environ.get("LOG_LEVEL", "DEBUG"))
 
-parsed_url = urlparse(os.environ['OPENAI_BASE_URL'])
-TARGET_URL = f"{parsed_url.scheme}://{parsed_url.netloc}"
+Headers = List[Tuple[bytes, bytes]]
 
-# 全局唯一的 httpx.AsyncClient 实例
-client: None | httpx.AsyncClient = None
+# 逐跳头部，只在单个连接上有效，代理不能转发
+HOP_BY_HOP_HEADERS = {b"connection", b"keep-alive", b"proxy-authenticate", b"proxy-authorization", b"te", b"trailer",
+                      b"trailers", b"transfer-encoding", b"upgrade", b"proxy-connection"}
+# 透传请求时由代理重新设置的请求头
+UPSTREAM_REQUEST_HEADERS = {b"host", b"x-forwarded-host"}
+# 透传响应时由代理重新设置的响应头
+CORS_RESPONSE_HEADERS = {b"access-control-allow-origin", b"access-control-allow-credentials"}
+
+# 跨域：允许所有来源、方法与请求头，允许携带凭证
+CORS_ALLOW_METHODS = b"DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT"
+CORS_MAX_AGE = b"600"
+
+JSON_HEADERS = [(b"content-type", b"application/json")]
+SSE_HEADERS = [(b"content-type", b"text/event-stream; charset=utf-8")]
+
+
+def _strip_hop_by_hop(headers: Iterable[Tuple[bytes, bytes]], drop: Iterable[bytes] = ()) -> Headers:
+    """
+    去掉逐跳头部，包括Connection头中列出的头部
+
+    :param headers: 小写头部名的(名, 值)列表
+    :param drop: 额外去掉的头部
+    """
+    headers = list(headers)
+    drop = HOP_BY_HOP_HEADERS.union(drop)
+    for name, value in headers:
+        if name == b"connection":
+            drop = drop.union(token.strip().lower() for token in value.split(b","))
+    return [(name, value) for name, value in headers if name not in drop]
+
+
+def _header(scope: Dict, name: bytes) -> bytes | None:
+    """
+    读取请求头，不存在时返回None
+    """
+    for key, value in scope["headers"]:
+        if key == name:
+            return value
+    return None
+
+
+def _header_number(scope: Dict, name: bytes, default: int | None) -> int | None:
+    """
+    读取整数请求头，缺失或非法时返回默认值
+    """
+    try:
+        return int(_header(scope, name))
+    except (TypeError, ValueError):
+        return default
+
+
+def _cors_headers(scope: Dict) -> Headers:
+    """
+    跨域响应头，在响应开始时一次性加上。带cookie的请求回显Origin，否则为*
+    """
+    origin = _header(scope, b"origin")
+    if origin is None:
+        return [(b"access-control-allow-origin", b"*")]
+    if _header(scope, b"cookie") is not None:
+        return [(b"access-control-allow-origin", origin), (b"access-control-allow-credentials", b"true"),
+                (b"vary", b"Origin")]
+    return [(b"access-control-allow-origin", b"*"), (b"access-control-allow-credentials", b"true")]
+
+
+async def _send_response(send, status: int, body: bytes, headers: Headers):
+    await send({"type": "http.response.start", "status": status,
+                "headers": headers + [(b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _send_json(scope: Dict, send, content, status: int = 200, headers: Headers = ()):
+    await _send_response(send, status, ujson.dumps(content, ensure_ascii=False).encode(),
+                         JSON_HEADERS + list(headers) + _cors_headers(scope))
+
+
+async def _send_stream(receive, send, status: int, headers: Headers, body: AsyncIterator[bytes | str],
+                       on_close: Callable[[], Awaitable | None] | None = None):
+    """
+    流式响应：客户端读一块才向上游读一块，客户端断开时立即停止读取并关闭body
+
+    :param on_close: 响应结束或客户端断开后调用
+    """
+
+    async def pump():
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        async for chunk in body:
+            await send({"type": "http.response.body",
+                        "body": chunk if isinstance(chunk, bytes) else chunk.encode(),
+                        "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def wait_disconnect():
+        # 请求体已经读完，之后只会收到断开消息
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    pump_task = asyncio.ensure_future(pump())
+    disconnect_task = asyncio.ensure_future(wait_disconnect())
+    try:
+        await asyncio.wait({pump_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in (pump_task, disconnect_task):
+            if not task.done():
+                task.cancel()
+        await asyncio.wait({pump_task, disconnect_task})
+        if hasattr(body, "aclose"):
+            await body.aclose()
+        if on_close is not None:
+            result = on_close()
+            if result is not None:
+                await result
+    if not pump_task.cancelled() and pump_task.exception() is not None:
+        raise pump_task.exception()
+
+
+async def _read_body(receive) -> bytes | None:
+    """
+    读取完整请求体，客户端中途断开时返回None
+    """
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def _iter_body(receive) -> AsyncIterator[bytes]:
+    """
+    请求体以流的方式交给上游
+    """
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+        if message.get("body"):
+            yield message["body"]
+        if not message.get("more_body"):
+            return
 
 
-@app.on_event("startup")
 async def startup_event():
-    global client
-    client = httpx.AsyncClient()
-    logger.info("HTTP client initialized")
+    await upstream_transport.warm_up((upstream.url for upstream in upstream_pool.upstreams),
+                                     {"Authorization": f"Bearer {API_KEY}"})
+    upstream_pool.start_health_checks(upstream_transport.client)
 
 
-@app.on_event("shutdown")
 async def shutdown_event():
-    global client
-    await client.aclose()
+    await upstream_pool.stop_health_checks()
+    await upstream_transport.aclose()
     logger.info("HTTP client closed")
+    if request_log:
+        request_log.close()
+    if sse_recorder:
+        sse_recorder.close()
 
 
-@app.middleware("http")
-async def proxy_middleware(request: Request, call_next):
-    # 构建目标URL
-    url = f"{TARGET_URL}{request.url.path}"
-    logger.debug(f"target url: {url}")
-    # 获取请求方法
-    method = request.method
+# 代理自身的统计接口：路径 -> 统计函数，均为GET
+STATS_ROUTES: Dict[str, Callable[[], Dict]] = {
+    # 响应缓存命中统计
+    "/proxy/cache/stats": lambda: response_cache.stats() if response_cache else {"enabled": False},
+    # 在途请求合并统计
+    "/proxy/single_flight/stats": lambda: single_flight.stats() if single_flight else {"enabled": False},
+    # 各上游的在途请求数与延迟
+    "/proxy/upstreams": upstream_pool.stats,
+    # 准入控制的并发、队列深度与排队时间
+    "/proxy/admission": lambda: admission.stats() if admission else {"enabled": False},
+    # 提前结束上游生成的次数与估计节省的token数
+    "/proxy/early_stop/stats": early_stop_stats.stats,
+    # 对冲请求的次数、胜负与当前的对冲延迟
+    "/proxy/hedging/stats": lambda: hedger.stats() if hedger else {"enabled": False},
+    # 抽样请求日志的写入与丢弃数
+    "/proxy/request_log/stats": lambda: request_log.stats() if request_log else {"enabled": False},
+    # 上下文压缩前后的token数
+    "/proxy/compaction/stats": lambda: context_compactor.stats() if context_compactor else {"enabled": False},
+    # 上游连接池的连接数与复用率
+    "/proxy/transport/stats": upstream_transport.stats,
+    # 工具调用参数的校验、修复与追问结果
+    "/proxy/tool_validation/stats": lambda: tool_validator.stats() if tool_validator else {"enabled": False},
+    # 上游响应的录制数（回放统计见/proxy/transport/stats）
+    "/proxy/sse_record/stats": lambda: sse_recorder.stats() if sse_recorder else {"enabled": False},
+}
 
-    # 获取请求头
-    headers = dict(request.headers)
-    parsed_url = urlparse(url)
-    host = parsed_url.netloc
-    headers["host"] = headers["x-forwarded-host"] = host
 
-    if method == "POST" and "/v1/chat/completions" == request.url.path:
-        data = await request.json()
-        logger.debug(f"{data=}")
+async def metrics_endpoint(scope: Dict, receive, send):
+    # Prometheus指标，多worker时汇总所有worker
+    content, content_type = metrics.render()
+    await _send_response(send, 200, content, [(b"content-type", content_type.encode())] + _cors_headers(scope))
 
-        stream_gen = await openai_stream(data=data, path=request.url.path, channel="openai")
 
-        if data.get("stream", False):
-            resp = StreamingResponse(stream_gen, media_type="text/event-stream")
-        else:
-            resp = Response(ujson.dumps(stream_gen, ensure_ascii=False), status_code=200,
-                            headers={"content-Type": "application/json"})
+async def cors_preflight(scope: Dict, receive, send):
+    # 跨域预检请求，允许所有来源、方法与请求头
+    headers = [(b"access-control-allow-origin", _header(scope, b"origin") or b"*"),
+               (b"access-control-allow-credentials", b"true"),
+               (b"access-control-allow-methods", CORS_ALLOW_METHODS),
+               (b"access-control-max-age", CORS_MAX_AGE),
+               (b"vary", b"Origin"),
+               (b"content-type", b"text/plain; charset=utf-8")]
+    if requested_headers := _header(scope, b"access-control-request-headers"):
+        headers.append((b"access-control-allow-headers", requested_headers))
+    await _send_response(send, 200, b"OK", headers)
 
-        resp.headers["Access-Control-Allow-Origin"] = "*"
 
-        return resp
-    elif ((await request.body()) and (await request.json()).get("stream")) or request.query_params.get("stream"):
-        # 通用流式处理，应该基本没啥用
-        data = await request.json()
-        logger.debug(f"{data=}")
+async def chat_completions(scope: Dict, receive, send):
+    start = time.perf_counter()
+    path = scope["path"]
+    # 准入控制，拿不到执行机会的请求提前拒绝
+    ticket = None
+    if admission:
+        try:
+            authorization = _header(scope, b"authorization")
+            ticket = await admission.acquire(
+                AdmissionController.key_of(authorization.decode("latin-1") if authorization else None),
+                priority=_header_number(scope, b"x-priority", 0),
+                deadline_ms=_header_number(scope, b"x-request-deadline-ms", None))
+        except AdmissionRejected as e:
+            await _send_json(scope, send, {"error": {"message": e.reason, "type": "overloaded", "code": e.status_code}},
+                             status=e.status_code, headers=[(b"retry-after", str(e.retry_after).encode())])
+            return
+    try:
+        body = await _read_body(receive)
+        if body is None:
+            if ticket:
+                admission.release(ticket)
+            return
+        data = ujson.loads(body)
+        logger.debug("data={!r}", data)
+        labels = metrics.request_labels(path, data)
+        # 抽样记录完整的请求与响应
+        log_record = request_log.begin(path, data) if request_log and request_log.sample() else None
 
-        resp = StreamingResponse(
-            openai_stream(data=data, method=method, path=request.url.path, channel="httpx"),
-            media_type="text/event-stream")
-        resp.headers["Access-Control-Allow-Origin"] = "*"
+        stream_gen = await openai_stream(data=data, path=path, channel="openai")
+    except BaseException:
+        if ticket:
+            admission.release(ticket)
+        raise
 
-        return resp
+    if data.get("stream", False):
+        if log_record:
+            stream_gen = request_log.capture_stream(stream_gen, log_record)
+        # 流结束后交还准入凭证
+        await _send_stream(receive, send, 200, SSE_HEADERS + _cors_headers(scope),
+                           metrics.observe_stream(stream_gen, labels, start),
+                           on_close=(lambda: admission.release(ticket)) if ticket else None)
     else:
-        # 获取请求体
-        body = await request.body()
-        # 发送请求到目标服务
-        response = await client.request(
+        if ticket:
+            admission.release(ticket)
+        if log_record:
+            request_log.submit(log_record, response=stream_gen)
+        await _send_json(scope, send, stream_gen)
+        duration = time.perf_counter() - start
+        metrics.DOWNSTREAM_TTFB.labels(*labels).observe(duration)
+        metrics.REQUEST_DURATION.labels(*labels).observe(duration)
+
+
+async def passthrough(scope: Dict, receive, send):
+    """
+    其他请求原样转发给上游，请求体与响应体都以流的方式透传，不做缓冲与JSON解析
+    """
+    method = scope["method"]
+    headers = _strip_hop_by_hop(scope["headers"], UPSTREAM_REQUEST_HEADERS)
+    has_body = any(name in (b"content-length", b"transfer-encoding") for name, _ in scope["headers"])
+    query_string = scope["query_string"]
+    # 连接不上的上游换一个重试，此时请求体还没有被读取
+    tried = []
+    for attempt in range(upstream_pool.max_attempts):
+        upstream = upstream_pool.pick(exclude=tried)
+        tried.append(upstream)
+        # 构建目标URL
+        url = f"{upstream.url}{scope['path']}"
+        if query_string:
+            url += "?" + query_string.decode("latin-1")
+        logger.debug("target url: {}", url)
+        host = upstream.host.encode()
+        upstream_request = upstream_transport.client.build_request(
             method=method,
             url=url,
-            headers=headers,
-            content=body,
-            params=request.query_params
+            headers=headers + [(b"host", host), (b"x-forwarded-host", host)],
+            content=_iter_body(receive) if has_body else None,
         )
+        upstream_pool.begin(upstream)
+        start = time.monotonic()
+        try:
+            response = await upstream_transport.client.send(upstream_request, stream=True)
+            break
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            metrics.upstream_error(upstream.host, e)
+            upstream_pool.end(upstream, failed=True)
+            if attempt == upstream_pool.max_attempts - 1:
+                raise
+            logger.warning(f"upstream {upstream.api_base} connect failed, failover: {e!r}")
+        except Exception as e:
+            # 请求体可能已经读取，不能重试，只交还在途计数并记录失败
+            metrics.upstream_error(upstream.host, e)
+            upstream_pool.end(upstream, failed=True)
+            raise
+    latency = time.monotonic() - start
+
+    async def close_upstream():
+        await response.aclose()
+        upstream_pool.end(upstream, latency, failed=response.status_code >= 500)
+
+    await _send_stream(receive, send, response.status_code,
+                       _strip_hop_by_hop(response.headers.raw, CORS_RESPONSE_HEADERS) + _cors_headers(scope),
+                       response.aiter_raw(), on_close=close_upstream)
+
 
-        # 构建响应
-        return Response(await response.aread(), status_code=response.status_code, headers=response.headers)
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await startup_event()
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": repr(e)})
+                raise
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await shutdown_event()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope: Dict, receive, send):
+    """
+    ASGI入口：显式路由聊天补全、指标与统计接口，其余请求透传给上游
+    """
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    method = scope["method"]
+    path = scope["path"]
+    if method == "POST" and path == "/v1/chat/completions":
+        await chat_completions(scope, receive, send)
+    elif method == "OPTIONS" and _header(scope, b"access-control-request-method") is not None:
+        await cors_preflight(scope, receive, send)
+    elif method == "GET" and path in STATS_ROUTES:
+        await _send_json(scope, send, STATS_ROUTES[path]())
+    elif method == "GET" and path == "/metrics":
+        await metrics_endpoint(scope, receive, send)
+    else:
+        await passthrough(scope, receive, send)
 
 
 if __name__ == "__main__":
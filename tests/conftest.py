@@ -0,0 +1,6 @@
+import os
+
+# main与utilities.upstreams在导入时读取上游配置，测试不连接上游
+os.environ.setdefault("OPENAI_BASE_URL", "http://127.0.0.1:9/v1")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
@@ -0,0 +1,43 @@
+import asyncio
+
+from utilities.admission import AdmissionController
+
+
+def test_per_key_limited_waiter_does_not_block_other_keys():
+    async def run():
+        controller = AdmissionController(max_concurrency=4, max_per_key=1)
+        ticket_a = await controller.acquire("a")
+        # a的第二个请求被按key限流，排队
+        waiting_a = asyncio.create_task(controller.acquire("a"))
+        await asyncio.sleep(0)
+        assert len(controller._queue) == 1
+        # 全局还有空位，b直接放行，不排在a后面
+        ticket_b = await asyncio.wait_for(controller.acquire("b"), timeout=1)
+        assert controller.active == 2
+        assert not waiting_a.done()
+        controller.release(ticket_a)
+        ticket_a2 = await asyncio.wait_for(waiting_a, timeout=1)
+        controller.release(ticket_a2)
+        controller.release(ticket_b)
+        assert controller.active == 0
+
+    asyncio.run(run())
+
+
+def test_runnable_waiter_keeps_its_place():
+    async def run():
+        controller = AdmissionController(max_concurrency=1)
+        ticket = await controller.acquire("a")
+        waiting_b = asyncio.create_task(controller.acquire("b"))
+        await asyncio.sleep(0)
+        # 全局已满时新请求排队，先到的先放行
+        waiting_c = asyncio.create_task(controller.acquire("c"))
+        await asyncio.sleep(0)
+        assert len(controller._queue) == 2
+        controller.release(ticket)
+        ticket_b = await asyncio.wait_for(waiting_b, timeout=1)
+        assert not waiting_c.done()
+        controller.release(ticket_b)
+        controller.release(await asyncio.wait_for(waiting_c, timeout=1))
+
+    asyncio.run(run())
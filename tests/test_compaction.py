@@ -0,0 +1,52 @@
+from utilities.compaction import ELIDED_TOOL_RESULT, ContextCompactor
+
+
+def _agent_loop(user_turns: int, tool_rounds: int, result_chars: int = 4000):
+    """
+    一条（或几条）用户消息之后跟着多轮工具调用的agent循环
+    """
+    messages = [{"role": "system", "content": "you are an agent"}]
+    for turn in range(user_turns):
+        messages.append({"role": "user", "content": f"task {turn}"})
+    for i in range(tool_rounds):
+        messages.append({"role": "assistant", "content": None,
+                         "tool_calls": [{"id": f"call_{i}", "type": "function",
+                                         "function": {"name": "read_file", "arguments": f'{{"path": "f{i}.txt"}}'}}]})
+        messages.append({"role": "tool", "tool_call_id": f"call_{i}", "content": "x" * result_chars})
+    return messages
+
+
+def test_single_user_message_loop_is_compacted():
+    messages = _agent_loop(user_turns=1, tool_rounds=20)
+    for keep_turns in (1, 2):
+        compactor = ContextCompactor(budget=2000, keep_turns=keep_turns, truncate_tokens=64)
+        compacted, before, after = compactor.compact(messages)
+        # 受保护的最近几轮本身接近预算，之前的工具结果都要被压缩
+        assert after < before // 4
+        assert after <= 2000 or compactor.over_budget
+        # 最近keep_turns轮的工具结果、system消息与用户消息保持不变
+        assert compacted[-2 * keep_turns:] == messages[-2 * keep_turns:]
+        assert compacted[0] == messages[0]
+        assert {"role": "user", "content": "task 0"} in compacted
+
+
+def test_old_tool_results_are_elided_before_dropping():
+    messages = _agent_loop(user_turns=2, tool_rounds=20)
+    compactor = ContextCompactor(budget=5000, keep_turns=2, truncate_tokens=64)
+    compacted, before, after = compactor.compact(messages)
+    assert after <= 5000 < before
+    assert len(compacted) == len(messages)
+    assert compacted[4]["content"] != messages[4]["content"]
+    assert compacted[-1] == messages[-1] and compacted[-3] == messages[-3]
+
+
+def test_dropping_keeps_tool_calls_paired_with_results():
+    messages = _agent_loop(user_turns=1, tool_rounds=20)
+    compactor = ContextCompactor(budget=200, keep_turns=2, truncate_tokens=64)
+    compacted, _, _ = compactor.compact(messages)
+    assert compactor.dropped
+    assert compacted[:2] == messages[:2]
+    call_ids = {tool_call["id"] for message in compacted for tool_call in message.get("tool_calls") or []}
+    result_ids = {message["tool_call_id"] for message in compacted if message["role"] == "tool"}
+    assert call_ids == result_ids
+    assert all(message["content"] != ELIDED_TOOL_RESULT for message in compacted[-4:])
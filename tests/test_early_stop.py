@@ -0,0 +1,19 @@
+from utilities.openai_tool import EarlyStopStats
+
+
+def test_tokens_saved_from_max_tokens():
+    stats = EarlyStopStats()
+    stats.record("max_tool_calls", 30, max_tokens=100, n=2)
+    assert stats.tokens_saved_estimate == 170
+
+
+def test_tokens_saved_without_max_tokens():
+    stats = EarlyStopStats()
+    # 尚无正常结束的生成，无从估计
+    stats.record("trailing_text", 10)
+    assert stats.tokens_saved_estimate == 0
+    stats.observe_completion(80)
+    stats.observe_completion(240, n=2)
+    stats.record("trailing_text", 30)
+    assert stats.tokens_saved_estimate == 77
+    assert stats.stats()["avg_completion_chunks"] == 106.7
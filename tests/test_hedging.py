@@ -0,0 +1,54 @@
+import asyncio
+
+from utilities.hedging import Hedger
+
+
+async def _slow_upstream():
+    await asyncio.sleep(0.1)
+    yield "chunk"
+
+
+async def _consume(hedger: Hedger):
+    return [item async for item in hedger.race(_slow_upstream, stream=True)]
+
+
+def test_hedge_rate_cap_holds_under_burst():
+    async def run():
+        hedger = Hedger(delay=0.02, max_rate=0.5)
+        # 60个请求同时到达对冲延迟，对冲数不超过比例上限
+        results = await asyncio.gather(*(_consume(hedger) for _ in range(60)))
+        assert all(result == ["chunk"] for result in results)
+        assert hedger.requests == 60
+        assert hedger.hedged <= 30
+        assert hedger.hedged + hedger.rate_limited == 60
+
+    asyncio.run(run())
+
+
+def test_hedge_window_eviction():
+    async def run():
+        hedger = Hedger(delay=0.02, max_rate=0.5, window=4)
+        for _ in range(3):
+            await asyncio.gather(*(_consume(hedger) for _ in range(8)))
+        assert hedger.requests == 24
+        assert 0 <= hedger._recent_hedges <= len(hedger._recent) * 0.5
+        assert hedger._recent_hedges == sum(bool(slot[0]) for slot in hedger._recent)
+
+    asyncio.run(run())
+
+
+async def _empty_upstream():
+    await asyncio.sleep(0.05)
+    return
+    yield
+
+
+def test_empty_upstream_is_a_finished_stream():
+    async def run():
+        # 不对冲与对冲时，没有数据就结束的上游都当作已完成的空流
+        for hedger in (Hedger(), Hedger(delay=0.01, max_rate=1)):
+            assert [item async for item in hedger.race(_empty_upstream, stream=False)] == []
+        assert hedger.hedged == 1
+        assert hedger.wins + hedger.losses == 1
+
+    asyncio.run(run())
@@ -0,0 +1,59 @@
+import asyncio
+
+import ujson
+
+from utilities.completion_accumulator import ChatCompletionAccumulator
+from utilities.dialects import DIALECTS
+from utilities.openai_tool import _choice_tool_calls_to_openai, _tool_calling_transfer_to_openai
+
+HERMES_TRAILING_COMMA = 'Let me check.\n<tool_call>{"name": "f", "arguments": {"a": 1,}}</tool_call>'
+LLAMA3_TRAILING_COMMA = '<|python_tag|>{"name": "f", "parameters": {"a": 1,}}'
+HERMES_NOT_JSON = 'Let me check.\n<tool_call>call f with a=1</tool_call>'
+LLAMA3_NOT_JSON = '<|python_tag|>print(f(a=1))'
+
+
+def _convert(dialect: str, content: str) -> dict:
+    choice = {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+    _choice_tool_calls_to_openai(choice, DIALECTS[dialect])
+    return choice
+
+
+def _stream(dialect: str, content: str, step: int = 7, checker=None) -> dict:
+    """
+    content按step个字符切成上游的流式chunk，经转换后拼装成完整响应
+    """
+    def frame(delta: dict, finish_reason=None) -> bytes:
+        return ("data: " + ujson.dumps({"id": "c", "object": "chat.completion.chunk", "created": 0, "model": "m",
+                                        "choices": [{"index": 0, "delta": delta, "logprobs": None,
+                                                     "finish_reason": finish_reason}]}) + "\n\n").encode()
+
+    async def frames():
+        yield frame({"role": "assistant"})
+        for i in range(0, len(content), step):
+            yield frame({"content": content[i:i + step]})
+        yield frame({}, "stop")
+        yield b"data: [DONE]\n\n"
+
+    async def run():
+        accumulator = ChatCompletionAccumulator()
+        async for chunk in _tool_calling_transfer_to_openai(frames(), dialect=DIALECTS[dialect], checker=checker):
+            accumulator.add_sse(chunk)
+        return accumulator.completion()["choices"][0]
+
+    return asyncio.run(run())
+
+
+def test_malformed_arguments_are_kept_for_repair():
+    for dialect, content in (("hermes", HERMES_TRAILING_COMMA), ("llama3", LLAMA3_TRAILING_COMMA)):
+        for choice in (_convert(dialect, content), _stream(dialect, content)):
+            assert choice["finish_reason"] == "tool_calls"
+            tool_calls = choice["message"]["tool_calls"]
+            assert [(t["function"]["name"], t["function"]["arguments"]) for t in tool_calls] == [("f", '{"a": 1,}')]
+
+
+def test_unparseable_call_is_restored_as_content():
+    for dialect, content in (("hermes", HERMES_NOT_JSON), ("llama3", LLAMA3_NOT_JSON)):
+        for choice in (_convert(dialect, content), _stream(dialect, content)):
+            assert choice["finish_reason"] == "stop"
+            assert not choice["message"].get("tool_calls")
+            assert choice["message"]["content"] == content
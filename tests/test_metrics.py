@@ -0,0 +1,13 @@
+from utilities import metrics
+
+
+def test_model_label_is_bounded(monkeypatch):
+    monkeypatch.setattr(metrics, "_seen_models", set())
+    monkeypatch.setattr(metrics, "METRICS_MAX_MODELS", 2)
+    assert [metrics.model_label(model) for model in ("a", "b", "c", "a", "b")] == ["a", "b", "other", "a", "b"]
+
+
+def test_model_label_from_configuration(monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_MODELS", frozenset({"qwen"}))
+    assert metrics.request_labels("/v1/chat/completions", {"model": "qwen"})[1] == "qwen"
+    assert metrics.request_labels("/v1/chat/completions", {"model": "random-123"})[1] == "other"
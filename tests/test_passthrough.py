@@ -0,0 +1,32 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+from utilities.upstreams import upstream_pool
+
+
+async def _receive():
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+
+async def _send(message):
+    pass
+
+
+@pytest.mark.parametrize("error", [httpx.RemoteProtocolError("server disconnected"),
+                                   httpx.ReadTimeout("read timed out")])
+def test_failed_send_ends_upstream_request(monkeypatch, error):
+    async def fail(request, stream=False):
+        raise error
+
+    monkeypatch.setattr(main.upstream_transport.client, "send", fail)
+    upstream = upstream_pool.upstreams[0]
+    in_flight, failures = upstream.in_flight, upstream.failures
+    scope = {"type": "http", "method": "GET", "path": "/v1/models", "query_string": b"", "headers": []}
+    for _ in range(3):
+        with pytest.raises(type(error)):
+            asyncio.run(main.passthrough(scope, _receive, _send))
+    assert upstream.in_flight == in_flight
+    assert upstream.failures == failures + 3
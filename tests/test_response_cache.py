@@ -0,0 +1,30 @@
+import asyncio
+
+from utilities.response_cache import ResponseCache, request_fingerprint
+
+REQUEST = {"model": "m", "messages": [{"role": "user", "content": "hi"}], "temperature": 0}
+
+
+def test_stream_and_non_stream_are_cached_separately():
+    assert request_fingerprint(dict(REQUEST, stream=True)) != request_fingerprint(REQUEST)
+    assert request_fingerprint(dict(REQUEST, stream=True, stream_options={"include_usage": True})) == \
+           request_fingerprint(dict(REQUEST, stream=True))
+
+
+def test_sampled_requests_bypass_cache():
+    cache = ResponseCache(max_size=8)
+    assert cache.cacheable(REQUEST)
+    assert not cache.cacheable({k: v for k, v in REQUEST.items() if k != "temperature"})
+    assert not cache.cacheable(dict(REQUEST, temperature=0.7))
+    assert not cache.cacheable(dict(REQUEST, n=2))
+    assert cache.stats()["bypassed"] == 3
+    assert ResponseCache(max_size=8, sampled=True).cacheable(dict(REQUEST, temperature=0.7, n=2))
+
+
+def test_get_returns_copy():
+    cache = ResponseCache(max_size=8)
+    key = request_fingerprint(REQUEST)
+    asyncio.run(cache.set(key, {"choices": []}))
+    cached = asyncio.run(cache.get(key))
+    cached["choices"].append(1)
+    assert asyncio.run(cache.get(key)) == {"choices": []}
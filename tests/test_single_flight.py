@@ -0,0 +1,10 @@
+from utilities.single_flight import flight_key
+
+REQUEST = {"model": "m", "messages": [{"role": "user", "content": "hi"}], "stream": True}
+
+
+def test_flight_key_includes_stream_options():
+    with_usage = dict(REQUEST, stream_options={"include_usage": True})
+    assert flight_key(with_usage) != flight_key(REQUEST)
+    assert flight_key(dict(with_usage, user="a")) == flight_key(dict(with_usage, user="b"))
+    assert flight_key(dict(REQUEST, stream=False)) != flight_key(REQUEST)
@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+from test_json_dialects import HERMES_TRAILING_COMMA, LLAMA3_TRAILING_COMMA, _stream
+from utilities import openai_tool
+from utilities.dialects import DIALECTS
+from utilities.tool_validation import REPAIRED, ToolArgumentsValidator, repair_arguments
+
+TOOLS = [{"type": "function",
+          "function": {"name": "f", "parameters": {"type": "object", "properties": {"a": {"type": "integer"}},
+                                                   "required": ["a"]}}}]
+
+
+@pytest.fixture
+def validator(monkeypatch):
+    validator = ToolArgumentsValidator()
+    monkeypatch.setattr(openai_tool, "tool_validator", validator)
+    return validator
+
+
+def _checker(dialect: str) -> openai_tool._ToolCallChecker:
+    return openai_tool._ToolCallChecker(TOOLS, {"messages": []}, DIALECTS[dialect], "POST", "/v1/chat/completions",
+                                        "openai", ())
+
+
+def test_repair_arguments():
+    assert repair_arguments("{'a': 1,}") == {"a": 1}
+    assert repair_arguments('{"a": [1, 2') == {"a": [1, 2]}
+    assert repair_arguments('```json\n{"a": 1}\n```') == {"a": 1}
+    assert repair_arguments("") == {}
+
+
+class _Completion:
+    def __init__(self, content: str):
+        self._content = content
+
+    def to_dict(self):
+        return {"id": "c", "object": "chat.completion", "created": 0, "model": "m",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": self._content},
+                             "finish_reason": "stop"}]}
+
+
+def _complete(monkeypatch, dialect: str, content: str) -> dict:
+    async def upstream(*args, **kwargs):
+        yield _Completion(content)
+
+    monkeypatch.setattr(openai_tool, "_openai_stream", upstream)
+    completion = asyncio.run(openai_tool._tool_calling_completion({}, dialect=DIALECTS[dialect],
+                                                                  checker=_checker(dialect)))
+    return completion["choices"][0]
+
+
+def test_json_dialect_trailing_comma_is_repaired(monkeypatch, validator):
+    for dialect, content in (("hermes", HERMES_TRAILING_COMMA), ("llama3", LLAMA3_TRAILING_COMMA)):
+        for choice in (_stream(dialect, content, checker=_checker(dialect)), _complete(monkeypatch, dialect, content)):
+            assert choice["finish_reason"] == "tool_calls"
+            assert [(t["function"]["name"], t["function"]["arguments"])
+                    for t in choice["message"]["tool_calls"]] == [("f", '{"a":1}')]
+    assert validator.outcomes[REPAIRED] == 4
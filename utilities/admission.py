@@ -0,0 +1,205 @@
+"""
+准入控制：全局与按API key的并发上限，按优先级与截止时间排序的有界等待队列，无法按时开始的请求提前拒绝
+
+环境变量：
+    ADMISSION_MAX_CONCURRENCY：每个worker的全局并发上限，0表示不启用准入控制
+    ADMISSION_MAX_PER_KEY：每个API key的并发上限，0表示不限
+    ADMISSION_MAX_QUEUE：等待队列长度上限，队列满时返回429
+    ADMISSION_QUEUE_TIMEOUT：默认最长排队时间（秒），超时返回503
+
+请求头：
+    x-priority：整数，越大越优先，默认0
+    x-request-deadline-ms：最长排队时间（毫秒），覆盖ADMISSION_QUEUE_TIMEOUT
+"""
+import asyncio
+import hashlib
+import itertools
+import math
+import os
+import time
+from collections import defaultdict, deque
+from typing import Dict, List
+
+# EWMA平滑系数
+EWMA_ALPHA = 0.2
+
+
+class AdmissionRejected(Exception):
+    """
+    请求被拒绝，status_code为429或503
+    """
+
+    def __init__(self, status_code: int, retry_after: int, reason: str):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class Ticket:
+    """
+    准入凭证，请求结束时交还，重复交还无副作用
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.start = time.monotonic()
+        self.released = False
+
+
+class _Waiter:
+    _seq = itertools.count()
+
+    def __init__(self, key: str, priority: int, deadline: float):
+        self.key = key
+        self.deadline = deadline
+        self.enqueued = time.monotonic()
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        # 优先级高的在前，同优先级截止时间早的在前，再按到达顺序
+        self.sort_key = (-priority, deadline, next(self._seq))
+
+
+class AdmissionController:
+    """
+    单个worker内的准入控制
+    """
+
+    def __init__(self, max_concurrency: int, max_per_key: int = 0, max_queue: int = 256,
+                 queue_timeout: float = 30):
+        self.max_concurrency = max_concurrency
+        self.max_per_key = max_per_key
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._active_per_key: Dict[str, int] = defaultdict(int)
+        self._queue: List[_Waiter] = []
+        # 请求处理时长的EWMA（秒），用来估计排队时间
+        self.ewma_service_time: float | None = None
+        self.admitted = 0
+        self.rejected = defaultdict(int)
+        # 最近的排队时间（秒）
+        self._wait_times = deque(maxlen=1024)
+
+    @staticmethod
+    def key_of(authorization: str | None) -> str:
+        """
+        API key的摘要，避免在内存与统计中保存明文
+        """
+        return hashlib.sha1((authorization or "").encode()).hexdigest()[:12]
+
+    def _can_run(self, key: str) -> bool:
+        return self.active < self.max_concurrency and \
+            (not self.max_per_key or self._active_per_key[key] < self.max_per_key)
+
+    def _estimate_wait(self, ahead: int) -> float:
+        """
+        前面有ahead个请求排队时，估计还要等多久
+        """
+        service_time = self.ewma_service_time or 1.
+        return (ahead // self.max_concurrency + 1) * service_time
+
+    def _admit(self, key: str, enqueued: float) -> Ticket:
+        self.active += 1
+        self._active_per_key[key] += 1
+        self.admitted += 1
+        self._wait_times.append(time.monotonic() - enqueued)
+        return Ticket(key)
+
+    async def acquire(self, key: str, priority: int = 0, deadline_ms: float | None = None) -> Ticket:
+        """
+        申请执行，必要时排队
+
+        :param key: API key摘要
+        :param priority: 优先级，越大越优先
+        :param deadline_ms: 最长排队时间（毫秒）
+        :raises AdmissionRejected: 队列已满或无法在截止时间前开始
+        """
+        now = time.monotonic()
+        # 排队的请求都只是被各自的key限流时，其他key不必排在它们后面
+        if self._can_run(key) and not any(self._can_run(waiter.key) for waiter in self._queue):
+            return self._admit(key, now)
+
+        wait_estimate = self._estimate_wait(len(self._queue))
+        if len(self._queue) >= self.max_queue:
+            self.rejected["queue_full"] += 1
+            raise AdmissionRejected(429, math.ceil(wait_estimate), "admission queue is full")
+        deadline = now + (deadline_ms / 1000 if deadline_ms is not None else self.queue_timeout)
+        if now + wait_estimate > deadline and self.ewma_service_time is not None:
+            self.rejected["deadline"] += 1
+            raise AdmissionRejected(503, math.ceil(wait_estimate), "deadline can not be met")
+
+        waiter = _Waiter(key, priority, deadline)
+        self._queue.append(waiter)
+        try:
+            return await asyncio.wait_for(waiter.future, timeout=deadline - now)
+        except asyncio.TimeoutError:
+            self.rejected["timeout"] += 1
+            raise AdmissionRejected(503, math.ceil(self._estimate_wait(len(self._queue))),
+                                    "timed out waiting for admission")
+        except BaseException:
+            # 已经拿到凭证但等待方被取消，交还凭证
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release(waiter.future.result())
+            raise
+        finally:
+            if waiter in self._queue:
+                self._queue.remove(waiter)
+
+    def release(self, ticket: Ticket):
+        """
+        交还凭证，唤醒排队的请求
+        """
+        if ticket.released:
+            return
+        ticket.released = True
+        self.active -= 1
+        self._active_per_key[ticket.key] -= 1
+        if not self._active_per_key[ticket.key]:
+            del self._active_per_key[ticket.key]
+        service_time = time.monotonic() - ticket.start
+        self.ewma_service_time = service_time if self.ewma_service_time is None else \
+            EWMA_ALPHA * service_time + (1 - EWMA_ALPHA) * self.ewma_service_time
+        self._dispatch()
+
+    def _dispatch(self):
+        """
+        按优先级与截止时间放行排队的请求，被按key限流的请求不阻塞其他key
+        """
+        now = time.monotonic()
+        for waiter in sorted(self._queue, key=lambda w: w.sort_key):
+            if self.active >= self.max_concurrency:
+                break
+            if waiter.future.done():
+                continue
+            if waiter.deadline <= now:
+                continue
+            if self._can_run(waiter.key):
+                self._queue.remove(waiter)
+                waiter.future.set_result(self._admit(waiter.key, waiter.enqueued))
+
+    def stats(self) -> Dict:
+        wait_times = sorted(self._wait_times)
+        return {"pid": os.getpid(),
+                "active": self.active,
+                "active_keys": len(self._active_per_key),
+                "queue_depth": len(self._queue),
+                "max_concurrency": self.max_concurrency,
+                "max_per_key": self.max_per_key,
+                "max_queue": self.max_queue,
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected),
+                "ewma_service_time_ms": None if self.ewma_service_time is None else
+                round(self.ewma_service_time * 1000, 3),
+                "wait_time_p50_ms": round(wait_times[len(wait_times) // 2] * 1000, 3) if wait_times else None,
+                "wait_time_p99_ms": round(wait_times[min(len(wait_times) - 1, int(len(wait_times) * 0.99))] * 1000,
+                                          3) if wait_times else None}
+
+
+_max_concurrency = int(os.environ.get("ADMISSION_MAX_CONCURRENCY", 0))
+# 全局唯一的准入控制，未启用时为None
+admission: None | AdmissionController = AdmissionController(
+    max_concurrency=_max_concurrency,
+    max_per_key=int(os.environ.get("ADMISSION_MAX_PER_KEY", 0)),
+    max_queue=int(os.environ.get("ADMISSION_MAX_QUEUE", 256)),
+    queue_timeout=float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 30)),
+) if _max_concurrency > 0 else None
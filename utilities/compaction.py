@@ -0,0 +1,194 @@
+"""
+上下文压缩：估计请求的token数，超过预算时截断或省略较早的工具结果与较长的中间助手回复，必要时丢弃最早的轮次。
+system消息、工具定义、最后一条用户消息与最近的几轮工具调用保持不变
+
+环境变量：
+    CONTEXT_TOKEN_BUDGET：提示词（含工具定义与工具提示词）的token预算，0（默认）表示不压缩。应小于上游的上下文长度减去max_tokens
+    CONTEXT_KEEP_TURNS：保持不变的最近轮次数（每轮为一条助手消息及其工具结果），默认2
+    CONTEXT_TRUNCATE_TOKENS：较早的工具结果与助手回复截断到的token数，默认256
+"""
+import os
+from typing import Dict, List, Tuple
+
+from utilities import metrics
+
+# 每条消息的对话模板开销（角色标记等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+ELIDED_TOOL_RESULT = "[较早的工具结果已省略]"
+ELIDED_ASSISTANT = "[较早的回复已省略]"
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    快速估计文本的token数，不依赖分词器
+    """
+    chars = len(text)
+    # 非ASCII字符在UTF-8中多占的字节数，CJK字符每个多2字节
+    non_ascii = (len(text.encode()) - chars) // 2
+    # ASCII约4个字符一个token，CJK约1个字符一个token
+    return (chars - non_ascii + 3) // 4 + non_ascii
+
+
+def message_tokens(message: Dict) -> int:
+    """
+    单条消息的估计token数，包括内容、工具调用与模板开销
+    """
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    content = message.get("content")
+    if isinstance(content, str):
+        tokens += estimate_tokens(content)
+    elif isinstance(content, list):
+        tokens += sum(estimate_tokens(part.get("text") or "") for part in content if isinstance(part, dict))
+    for tool_call in message.get("tool_calls") or []:
+        function = tool_call.get("function") or {}
+        tokens += estimate_tokens(function.get("name") or "") + estimate_tokens(function.get("arguments") or "")
+    return tokens
+
+
+def _truncate(text: str, tokens: int, max_tokens: int) -> str:
+    """
+    保留开头约max_tokens个token，注明省略的token数
+    """
+    keep_chars = len(text) * max_tokens // tokens
+    return f"{text[:keep_chars]}…[已截断，省略约{tokens - max_tokens}个token]"
+
+
+class ContextCompactor:
+    """
+    按token预算压缩messages，依次：截断较早的长消息、省略较早的工具结果与助手回复、丢弃最早的轮次
+    """
+
+    def __init__(self, budget: int, keep_turns: int = 2, truncate_tokens: int = 256):
+        self.budget = budget
+        self.keep_turns = keep_turns
+        self.truncate_tokens = truncate_tokens
+        self.requests = 0
+        self.compacted = 0
+        # 仍超出预算（受保护的部分已经超出）
+        self.over_budget = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.truncated = 0
+        self.elided = 0
+        self.dropped = 0
+
+    def _protected_from(self, messages: List[Dict]) -> int:
+        """
+        最近keep_turns轮（助手消息及其工具结果）的起始下标，之后的消息不压缩。
+        按助手消息而不是用户消息计数：一条用户消息之后跟着多轮工具调用的agent循环里，较早的工具结果也能压缩
+        """
+        if self.keep_turns <= 0:
+            return len(messages)
+        turns = 0
+        for i in range(len(messages) - 1, -1, -1):
+            if messages[i].get("role") == "assistant":
+                turns += 1
+                if turns >= self.keep_turns:
+                    return i
+        return 0
+
+    @staticmethod
+    def _oldest_turn(messages: List[Dict], protected_from: int, last_user: int) -> Tuple[int, int] | None:
+        """
+        受保护部分之前最早的一轮[start, end)：一条用户消息到下一条用户消息之前，或一条助手消息及其工具结果，
+        工具调用与结果一起丢弃。system消息与最后一条用户消息不丢弃
+        """
+        start = next((i for i in range(protected_from)
+                      if i != last_user and messages[i].get("role") not in ("system", "developer")), None)
+        if start is None:
+            return None
+        if messages[start].get("role") == "user":
+            end = next((i for i in range(start + 1, protected_from) if messages[i].get("role") == "user"),
+                       protected_from)
+        else:
+            end = next((i for i in range(start + 1, protected_from) if messages[i].get("role") != "tool"),
+                       protected_from)
+        return start, end
+
+    @staticmethod
+    def _retokenize(messages: List[Dict], tokens: List[int], i: int) -> int:
+        """
+        重新估计改动后的第i条消息，返回token数的变化
+        """
+        old = tokens[i]
+        tokens[i] = message_tokens(messages[i])
+        return tokens[i] - old
+
+    def compact(self, messages: List[Dict], reserved: int = 0) -> Tuple[List[Dict], int, int]:
+        """
+        :param messages: 请求中的messages，不原地修改，改动的消息替换为新的字典
+        :param reserved: messages之外固定的token数，如工具定义与工具提示词
+        :return: (压缩后的messages, 压缩前的估计token数, 压缩后的估计token数)
+        """
+        self.requests += 1
+        tokens = [message_tokens(message) for message in messages]
+        before = total = reserved + sum(tokens)
+        if total > self.budget:
+            messages = list(messages)
+            protected_from = self._protected_from(messages)
+            compactable = [i for i in range(protected_from)
+                           if messages[i].get("role") in ("tool", "assistant")
+                           and isinstance(messages[i].get("content"), str)]
+            # 截断较早的长消息
+            for i in compactable:
+                if total <= self.budget:
+                    break
+                content_tokens = tokens[i] - MESSAGE_OVERHEAD_TOKENS
+                if content_tokens > self.truncate_tokens and messages[i]["content"]:
+                    messages[i] = dict(messages[i], content=_truncate(messages[i]["content"],
+                                                                      estimate_tokens(messages[i]["content"]),
+                                                                      self.truncate_tokens))
+                    total += self._retokenize(messages, tokens, i)
+                    self.truncated += 1
+            # 省略较早的工具结果与助手回复，保留消息本身，工具调用与结果仍然配对
+            for i in compactable:
+                if total <= self.budget:
+                    break
+                placeholder = ELIDED_TOOL_RESULT if messages[i]["role"] == "tool" else ELIDED_ASSISTANT
+                if messages[i]["content"] and messages[i]["content"] != placeholder:
+                    messages[i] = dict(messages[i], content=placeholder)
+                    total += self._retokenize(messages, tokens, i)
+                    self.elided += 1
+            # 丢弃最早的轮次，system消息与最后一条用户消息（当前任务）保留
+            last_user = next((i for i in range(len(messages) - 1, -1, -1) if messages[i].get("role") == "user"), -1)
+            while total > self.budget:
+                turn = self._oldest_turn(messages, protected_from, last_user)
+                if turn is None:
+                    break
+                dropped = {i for i in range(*turn) if messages[i].get("role") not in ("system", "developer")}
+                total -= sum(tokens[i] for i in dropped)
+                messages = [m for i, m in enumerate(messages) if i not in dropped]
+                tokens = [t for i, t in enumerate(tokens) if i not in dropped]
+                protected_from -= len(dropped)
+                if last_user > turn[0]:
+                    last_user -= len(dropped)
+                self.dropped += len(dropped)
+            self.compacted += 1
+            self.over_budget += total > self.budget
+        self.tokens_before += before
+        self.tokens_after += total
+        metrics.PROMPT_TOKENS.labels("before").observe(before)
+        metrics.PROMPT_TOKENS.labels("after").observe(total)
+        return messages, before, total
+
+    def stats(self) -> Dict:
+        return {"pid": os.getpid(),
+                "budget": self.budget,
+                "requests": self.requests,
+                "compacted": self.compacted,
+                "over_budget": self.over_budget,
+                "tokens_before": self.tokens_before,
+                "tokens_after": self.tokens_after,
+                "truncated_messages": self.truncated,
+                "elided_messages": self.elided,
+                "dropped_messages": self.dropped}
+
+
+_budget = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 0))
+# 全局唯一的上下文压缩，未启用时为None
+context_compactor: None | ContextCompactor = ContextCompactor(
+    budget=_budget,
+    keep_turns=int(os.environ.get("CONTEXT_KEEP_TURNS", 2)),
+    truncate_tokens=int(os.environ.get("CONTEXT_TRUNCATE_TOKENS", 256)),
+) if _budget > 0 else None
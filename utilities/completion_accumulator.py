@@ -0,0 +1,102 @@
+"""
+流式chunk拼装成完整的chat.completion响应体
+"""
+from typing import Dict, List
+
+import ujson
+
+
+class ChatCompletionAccumulator:
+    """
+    按choice序号累积OpenAI格式的流式chunk，最后拼装成非流式响应体
+    """
+
+    def __init__(self):
+        self._head: Dict = {}
+        # choice序号 -> {'content': [片段], 'role', 'tool_calls': {序号: tool_call}, 'finish_reason'}
+        self._choices: Dict[int, Dict] = {}
+        self._usage = None
+        # SSE帧切分的缓存
+        self._buffer = b""
+        # 是否收到data: [DONE]
+        self.complete = False
+
+    def add_sse(self, data: bytes | str):
+        """
+        累积一段SSE数据，不要求按帧切分
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        buffer = self._buffer + data if self._buffer else data
+        start = 0
+        while (end := buffer.find(b"\n\n", start)) >= 0:
+            self._add_frame(buffer[start:end])
+            start = end + 2
+        self._buffer = buffer[start:]
+
+    def _add_frame(self, frame: bytes):
+        frame = frame.strip()
+        if not frame.startswith(b"data:"):
+            return
+        payload = frame[5:].strip()
+        if payload == b"[DONE]":
+            self.complete = True
+            return
+        self.add_chunk(ujson.loads(payload))
+
+    def add_chunk(self, chunk: Dict):
+        """
+        累积一个chat.completion.chunk
+        """
+        if not self._head:
+            self._head = {'id': chunk.get('id'), 'created': chunk.get('created'), 'model': chunk.get('model')}
+        if chunk.get('usage'):
+            self._usage = chunk['usage']
+        for choice in chunk.get('choices') or []:
+            state = self._choices.setdefault(choice.get('index', 0), {
+                'content': [], 'role': 'assistant', 'tool_calls': {}, 'finish_reason': None})
+            delta = choice.get('delta') or {}
+            if delta.get('role'):
+                state['role'] = delta['role']
+            if delta.get('content'):
+                state['content'].append(delta['content'])
+            for tool_call in delta.get('tool_calls') or []:
+                cached = state['tool_calls'].setdefault(tool_call['index'], {
+                    'id': None, 'function': {'arguments': [], 'name': ''}, 'type': 'function'})
+                if tool_call.get('id'):
+                    cached['id'] = tool_call['id']
+                function = tool_call.get('function') or {}
+                if function.get('name'):
+                    cached['function']['name'] = function['name']
+                if function.get('arguments'):
+                    cached['function']['arguments'].append(function['arguments'])
+            if choice.get('finish_reason'):
+                state['finish_reason'] = choice['finish_reason']
+
+    def completion(self) -> Dict:
+        """
+        拼装成chat.completion响应体
+        """
+        choices: List[Dict] = []
+        for index in sorted(self._choices):
+            state = self._choices[index]
+            message = {'content': ''.join(state['content']) or None, 'role': state['role']}
+            if state['tool_calls']:
+                message['tool_calls'] = [
+                    {'id': tool_call['id'],
+                     'function': {'arguments': ''.join(tool_call['function']['arguments']),
+                                  'name': tool_call['function']['name']},
+                     'type': 'function'}
+                    for _, tool_call in sorted(state['tool_calls'].items())]
+            choices.append({'finish_reason': state['finish_reason'],
+                            'index': index,
+                            'logprobs': None,
+                            'message': message})
+        completion = {'id': self._head.get('id'),
+                      'choices': choices,
+                      'created': self._head.get('created'),
+                      'model': self._head.get('model'),
+                      'object': 'chat.completion'}
+        if self._usage:
+            completion['usage'] = self._usage
+        return completion
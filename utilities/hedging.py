@@ -0,0 +1,211 @@
+"""
+对冲请求：上游迟迟没有首个chunk时再发一个相同的请求，谁先返回用谁，另一个立即取消
+
+环境变量：
+    HEDGING：设为1启用
+    HEDGE_DELAY_MS：固定的对冲延迟（毫秒），未设置时取最近首chunk时间的HEDGE_PERCENTILE分位数
+    HEDGE_PERCENTILE：对冲延迟取的分位数，默认95
+    HEDGE_MIN_SAMPLES：样本数少于该值时不对冲
+    HEDGE_MAX_RATE：对冲请求占请求总数的比例上限，默认0.05
+    HEDGE_WINDOW：首chunk时间样本与对冲比例统计的窗口（请求数）
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from contextlib import aclosing
+from typing import AsyncGenerator, Callable, Dict, List
+
+from loguru import logger
+
+from utilities import metrics
+
+# 每新增多少个样本重新计算一次分位数
+_RECOMPUTE_EVERY = 32
+
+
+class Hedger:
+    """
+    单个worker内的对冲控制，流式与非流式请求的首chunk时间分别统计
+    """
+
+    def __init__(self, delay: float | None = None, percentile: float = 95, min_samples: int = 20,
+                 max_rate: float = 0.05, window: int = 1000):
+        """
+        :param delay: 固定的对冲延迟（秒），None表示按分位数
+        """
+        self.fixed_delay = delay
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_rate = max_rate
+        # 是否流式 -> 最近的首chunk时间（秒）
+        self._samples: Dict[bool, deque] = {True: deque(maxlen=window), False: deque(maxlen=window)}
+        self._delays: Dict[bool, float | None] = {True: None, False: None}
+        self._new_samples: Dict[bool, int] = {True: 0, False: 0}
+        # 最近的请求是否对冲过，用来限制对冲比例。请求开始时就占一格，决定对冲时立即标记，
+        # 同时到达对冲延迟的并发请求能看到彼此的对冲；移出窗口的格子标记为None
+        self._recent: deque[List[bool | None]] = deque(maxlen=window)
+        self._recent_hedges = 0
+        self.requests = 0
+        self.hedged = 0
+        # 对冲请求先返回
+        self.wins = 0
+        # 原请求先返回
+        self.losses = 0
+        # 到了对冲延迟但因比例上限没有对冲
+        self.rate_limited = 0
+
+    def delay(self, stream: bool) -> float | None:
+        """
+        当前的对冲延迟（秒），样本不足时为None
+        """
+        if self.fixed_delay is not None:
+            return self.fixed_delay
+        samples = self._samples[stream]
+        if len(samples) < self.min_samples:
+            return None
+        if self._delays[stream] is None or self._new_samples[stream] >= _RECOMPUTE_EVERY:
+            ordered = sorted(samples)
+            self._delays[stream] = ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))]
+            self._new_samples[stream] = 0
+        return self._delays[stream]
+
+    def _record_ttft(self, stream: bool, ttft: float):
+        self._samples[stream].append(ttft)
+        self._new_samples[stream] += 1
+
+    def _account(self) -> List[bool | None]:
+        """
+        请求开始时计入窗口，返回该请求的格子
+        """
+        if len(self._recent) == self._recent.maxlen:
+            evicted = self._recent[0]
+            self._recent_hedges -= bool(evicted[0])
+            evicted[0] = None
+        slot = [False]
+        self._recent.append(slot)
+        self.requests += 1
+        return slot
+
+    def _account_hedge(self, slot: List[bool | None]):
+        if slot[0] is not None:
+            slot[0] = True
+            self._recent_hedges += 1
+        self.hedged += 1
+
+    def _allow_hedge(self) -> bool:
+        # 当前请求已经计入窗口
+        return self._recent_hedges < self.max_rate * len(self._recent)
+
+    async def race(self, open_stream: Callable[[], AsyncGenerator], stream: bool) -> AsyncGenerator:
+        """
+        发起请求，超过对冲延迟还没有首个chunk时再发一个，转发先返回的那个
+
+        :param open_stream: 发起一次上游请求，返回上游数据的异步生成器
+        :param stream: 是否流式请求，流式与非流式的首chunk时间分开统计
+        """
+        start = time.monotonic()
+        primary = open_stream()
+        primary_first = asyncio.ensure_future(anext(primary))
+        winner, first, winner_start = primary, primary_first, start
+        slot = self._account()
+        # 上游没有任何数据就正常结束了
+        empty = False
+        try:
+            delay = self.delay(stream)
+            if delay is not None:
+                await asyncio.wait({primary_first}, timeout=delay)
+                if not primary_first.done():
+                    if self._allow_hedge():
+                        self._account_hedge(slot)
+                        winner, first, winner_start = await self._hedge(primary, primary_first, open_stream,
+                                                                        start)
+                    else:
+                        self.rate_limited += 1
+                        metrics.HEDGES.labels("rate_limited").inc()
+            try:
+                item = await first
+            except StopAsyncIteration:
+                empty = True
+        except BaseException:
+            if not primary_first.done():
+                primary_first.cancel()
+            await _close(primary_first, primary)
+            raise
+        self._record_ttft(stream, time.monotonic() - winner_start)
+
+        async with aclosing(winner):
+            if empty:
+                return
+            yield item
+            async for item in winner:
+                yield item
+
+    async def _hedge(self, primary: AsyncGenerator, primary_first: asyncio.Future,
+                     open_stream: Callable[[], AsyncGenerator], start: float):
+        """
+        发出对冲请求，返回先成功的(生成器, 首个chunk的future, 发出时间)，另一个立即取消并关闭
+        """
+        hedge = open_stream()
+        hedge_first = asyncio.ensure_future(anext(hedge))
+        contenders = {primary_first: primary, hedge_first: hedge}
+        hedge_start = time.monotonic()
+        try:
+            while True:
+                done, _ = await asyncio.wait(contenders, return_when=asyncio.FIRST_COMPLETED)
+                # 没有数据就结束的上游也算先返回，是一个已完成的空流
+                succeeded = [f for f in done if f.exception() is None or isinstance(f.exception(), StopAsyncIteration)]
+                # 两个都失败时抛出最后失败的那个
+                if succeeded or len(contenders) == len(done):
+                    first = succeeded[0] if succeeded else next(iter(done))
+                    break
+                # 一个失败了，继续等另一个
+                for f in done:
+                    await _close(f, contenders.pop(f))
+        except BaseException:
+            for f, gen in contenders.items():
+                f.cancel()
+                await _close(f, gen)
+            raise
+        winner = contenders.pop(first)
+        for f, gen in contenders.items():
+            f.cancel()
+            await _close(f, gen)
+        if first is hedge_first:
+            self.wins += 1
+            metrics.HEDGES.labels("win").inc()
+            logger.debug("hedged request won after {:.3f}s", time.monotonic() - hedge_start)
+            return winner, first, hedge_start
+        self.losses += 1
+        metrics.HEDGES.labels("loss").inc()
+        return winner, first, start
+
+    def stats(self) -> Dict:
+        return {"pid": os.getpid(),
+                "requests": self.requests,
+                "hedged": self.hedged,
+                "wins": self.wins,
+                "losses": self.losses,
+                "rate_limited": self.rate_limited,
+                "hedge_rate": self.hedged / self.requests if self.requests else 0.,
+                "delay_ms": {"stream" if stream else "non_stream":
+                                 None if (delay := self.delay(stream)) is None else round(delay * 1000, 3)
+                             for stream in (True, False)}}
+
+
+async def _close(first: asyncio.Future, gen: AsyncGenerator):
+    """
+    等待取消完成后关闭生成器，生成器关闭时释放上游连接
+    """
+    await asyncio.wait({first})
+    await gen.aclose()
+
+
+# 全局唯一的对冲控制，未启用时为None
+hedger: None | Hedger = Hedger(
+    delay=float(os.environ["HEDGE_DELAY_MS"]) / 1000 if os.environ.get("HEDGE_DELAY_MS") else None,
+    percentile=float(os.environ.get("HEDGE_PERCENTILE", 95)),
+    min_samples=int(os.environ.get("HEDGE_MIN_SAMPLES", 20)),
+    max_rate=float(os.environ.get("HEDGE_MAX_RATE", 0.05)),
+    window=int(os.environ.get("HEDGE_WINDOW", 1000)),
+) if os.environ.get("HEDGING") == "1" else None
@@ -0,0 +1,127 @@
+"""
+Prometheus指标：上下游首字节时间、chunk间隔、端到端耗时、改写与解析耗时、上游错误、上游连接复用、每个请求的工具调用数、工具调用参数的校验结果
+
+多个uvicorn worker时设置环境变量PROMETHEUS_MULTIPROC_DIR为一个空目录（每次启动前清空），/metrics汇总所有worker的数据
+
+环境变量：
+    METRICS_MODELS：逗号分隔的模型名，model标签只取其中的值，其余记为other
+    METRICS_MAX_MODELS：未设置METRICS_MODELS时，每个worker最多记录多少个先出现的模型，其余记为other，默认20
+"""
+import os
+import time
+from contextlib import aclosing
+from typing import AsyncGenerator, Dict, Tuple
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest, \
+    CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+
+# 请求维度的标签
+REQUEST_LABELS = ("path", "model", "stream", "tools")
+
+UPSTREAM_TTFB = Histogram(
+    "proxy_upstream_ttfb_seconds", "Time from sending the upstream request to its first byte",
+    REQUEST_LABELS, buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+DOWNSTREAM_TTFB = Histogram(
+    "proxy_downstream_ttfb_seconds", "Time from receiving the request to the first byte sent to the client",
+    REQUEST_LABELS, buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+INTER_CHUNK = Histogram(
+    "proxy_inter_chunk_seconds", "Gap between consecutive chunks sent to the client",
+    REQUEST_LABELS, buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+REQUEST_DURATION = Histogram(
+    "proxy_request_duration_seconds", "End to end request duration",
+    REQUEST_LABELS, buckets=(.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+STAGE_DURATION = Histogram(
+    "proxy_stage_seconds",
+    "Time spent in proxy stages per request: compact (context compaction), rewrite (request rewriting), "
+    "parse (tool call parsing)",
+    ("stage",), buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1))
+UPSTREAM_ERRORS = Counter(
+    "proxy_upstream_errors", "Failed upstream requests", ("upstream", "error"))
+TOOL_CALLS = Histogram(
+    "proxy_tool_calls_per_request", "Tool calls emitted per tool request", buckets=(0, 1, 2, 3, 4, 5))
+HEDGES = Counter(
+    "proxy_hedges", "Hedged upstream requests by outcome: win, loss, rate_limited", ("outcome",))
+EARLY_STOPS = Counter(
+    "proxy_early_stops", "Upstream generations stopped early", ("reason",))
+EARLY_STOP_TOKENS_SAVED = Counter(
+    "proxy_early_stop_tokens_saved", "Estimated upstream tokens not generated because of early stops", ("reason",))
+PROMPT_TOKENS = Histogram(
+    "proxy_prompt_tokens_estimate", "Estimated prompt tokens per request before and after context compaction",
+    ("stage",), buckets=(256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072))
+UPSTREAM_CONNECTIONS = Counter(
+    "proxy_upstream_requests_by_connection", "Upstream requests by connection: new, reused", ("connection",))
+TOOL_ARGUMENTS = Counter(
+    "proxy_tool_arguments",
+    "Tool call arguments by validation outcome: valid, repaired, reasked, invalid, unknown_tool", ("outcome",))
+
+# model标签的取值范围，避免客户端传入任意model时标签无限增长
+METRICS_MODELS = frozenset(model.strip() for model in os.environ.get("METRICS_MODELS", "").split(",") if model.strip())
+METRICS_MAX_MODELS = int(os.environ.get("METRICS_MAX_MODELS", 20))
+# 未配置METRICS_MODELS时已经作为标签出现过的模型
+_seen_models = set()
+
+
+def model_label(model: str) -> str:
+    """
+    model标签的值，不在配置中或超出数量上限的模型记为other
+    """
+    if METRICS_MODELS:
+        return model if model in METRICS_MODELS else "other"
+    if model not in _seen_models:
+        if len(_seen_models) >= METRICS_MAX_MODELS:
+            return "other"
+        _seen_models.add(model)
+    return model
+
+
+def request_labels(path: str, data: Dict) -> Tuple[str, str, str, str]:
+    """
+    请求维度的标签值，需在请求改写之前调用
+    """
+    return (path, model_label(str(data.get("model", ""))), "true" if data.get("stream") else "false",
+            "true" if data.get("tools") else "false")
+
+
+def upstream_error(upstream: str, e: BaseException):
+    """
+    记录一次上游错误，HTTP状态错误按状态码归类，其余按异常类型归类
+    """
+    status_code = getattr(e, "status_code", None) or getattr(getattr(e, "response", None), "status_code", None)
+    UPSTREAM_ERRORS.labels(upstream, str(status_code) if status_code else type(e).__name__).inc()
+
+
+async def observe_stream(stream_gen: AsyncGenerator, labels: Tuple[str, ...], start: float) -> AsyncGenerator:
+    """
+    统计发往客户端的流：首字节时间、chunk间隔与端到端耗时
+
+    :param stream_gen: 发往客户端的流
+    :param labels: request_labels的返回值
+    :param start: 收到请求的时间，time.perf_counter()
+    """
+    inter_chunk = INTER_CHUNK.labels(*labels)
+    last = None
+    try:
+        async with aclosing(stream_gen):
+            async for chunk in stream_gen:
+                now = time.perf_counter()
+                if last is None:
+                    DOWNSTREAM_TTFB.labels(*labels).observe(now - start)
+                else:
+                    inter_chunk.observe(now - last)
+                last = now
+                yield chunk
+    finally:
+        REQUEST_DURATION.labels(*labels).observe(time.perf_counter() - start)
+
+
+def render() -> Tuple[bytes, str]:
+    """
+    文本格式的指标与其Content-Type，多进程模式下汇总所有worker
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,124 @@
+"""
+抽样的完整请求/响应日志：序列化与写文件都在后台线程里做，不阻塞事件循环
+
+环境变量：
+    REQUEST_LOG_SAMPLE_RATE：抽样比例，0（默认）表示不记录，1表示全部记录
+    REQUEST_LOG_PATH：JSONL文件路径，多个worker追加写同一个文件，每条记录一次写入
+    REQUEST_LOG_QUEUE_SIZE：待写记录的上限，写不过来时丢弃新记录
+"""
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import aclosing
+from typing import AsyncGenerator, Dict
+
+import ujson
+from loguru import logger
+
+
+class RequestLog:
+    """
+    抽样记录请求与响应到JSONL文件
+    """
+
+    def __init__(self, path: str, sample_rate: float, queue_size: int = 1024):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.written = 0
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._write_loop, name="request-log", daemon=True)
+        self._thread.start()
+
+    def sample(self) -> bool:
+        """
+        本次请求是否记录
+        """
+        return random.random() < self.sample_rate
+
+    @staticmethod
+    def begin(path: str, data: Dict) -> Dict:
+        """
+        开始记录一个请求。请求体在之后会被原地改写，这里先序列化保留原样
+
+        :return: 记录，交给submit或capture_stream
+        """
+        return {"ts": time.time(), "pid": os.getpid(), "path": path, "start": time.perf_counter(),
+                "request": ujson.dumps(data, ensure_ascii=False)}
+
+    def submit(self, record: Dict, response: Dict | None = None, sse: list | None = None):
+        """
+        记录交给后台线程写入，不等待
+
+        :param response: 非流式响应体
+        :param sse: 流式响应的chunk列表
+        """
+        record["duration_ms"] = round((time.perf_counter() - record.pop("start")) * 1000, 3)
+        record["response"] = response
+        record["sse"] = sse
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    async def capture_stream(self, stream_gen: AsyncGenerator, record: Dict) -> AsyncGenerator:
+        """
+        转发流式响应并收集chunk，流结束（包括客户端断开）时提交记录
+        """
+        chunks = []
+        try:
+            async with aclosing(stream_gen):
+                async for chunk in stream_gen:
+                    chunks.append(chunk)
+                    yield chunk
+        finally:
+            self.submit(record, sse=chunks)
+
+    def _write_loop(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                record = self._queue.get()
+                if record is None:
+                    return
+                try:
+                    f.write(self._serialize(record))
+                    f.flush()
+                    self.written += 1
+                except Exception as e:
+                    logger.warning(f"request log write error: {e!r}")
+
+    @staticmethod
+    def _serialize(record: Dict) -> str:
+        request = record.pop("request")
+        sse = record.pop("sse")
+        if sse is not None:
+            # 原样透传的字节块可能从多字节字符中间切开，拼接后再解码
+            record["sse"] = b"".join(chunk if isinstance(chunk, bytes) else chunk.encode() for chunk in sse) \
+                .decode(errors="replace")
+        # 请求体已经是JSON字符串，直接拼接，不再解析一遍
+        return ujson.dumps(record, ensure_ascii=False)[:-1] + ',"request":' + request + "}\n"
+
+    def close(self):
+        """
+        写完队列里剩余的记录后结束后台线程
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self) -> Dict:
+        return {"pid": os.getpid(),
+                "sample_rate": self.sample_rate,
+                "written": self.written,
+                "dropped": self.dropped,
+                "pending": self._queue.qsize()}
+
+
+_sample_rate = float(os.environ.get("REQUEST_LOG_SAMPLE_RATE", 0))
+# 全局唯一的请求日志，未启用时为None
+request_log: None | RequestLog = RequestLog(
+    path=os.environ.get("REQUEST_LOG_PATH", "request_log.jsonl"),
+    sample_rate=_sample_rate,
+    queue_size=int(os.environ.get("REQUEST_LOG_QUEUE_SIZE", 1024)),
+) if _sample_rate > 0 else None
@@ -0,0 +1,185 @@
+"""
+chat completion的精确匹配响应缓存：内存LRU+TTL，可选sqlite磁盘层供多个uvicorn worker共享
+
+环境变量：
+    RESPONSE_CACHE_SIZE：内存缓存条数，0表示不启用内存层
+    RESPONSE_CACHE_TTL：缓存有效期（秒）
+    RESPONSE_CACHE_DISK_PATH：sqlite文件路径，设置后启用磁盘层
+    RESPONSE_CACHE_DISK_SIZE：磁盘层最大条数
+    RESPONSE_CACHE_SAMPLED：设为1时也缓存采样的请求（temperature不为0或n>1），默认只缓存确定性的请求
+"""
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict
+
+import ujson
+from loguru import logger
+
+# 不影响响应内容的字段，不参与缓存键。流式与非流式的响应转换不同（例如工具调用前的内容是否去掉首尾空白），分开缓存
+_IGNORED_KEYS = frozenset({"stream_options", "user"})
+
+
+def request_fingerprint(data: Dict, ignored_keys: frozenset = _IGNORED_KEYS) -> str:
+    """
+    改写后请求的规范化哈希，字段顺序无关
+
+    :param data: 改写后的请求体
+    :param ignored_keys: 不参与哈希的字段
+    """
+    key_data = {k: v for k, v in data.items() if k not in ignored_keys}
+    return hashlib.sha256(ujson.dumps(key_data, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+class _DiskTier:
+    """
+    sqlite磁盘层，WAL模式下多进程可以并发读写。所有方法都是阻塞的，需在线程中调用
+    """
+
+    def __init__(self, path: str, max_size: int):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, expire_at REAL, value TEXT)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS response_cache_expire ON response_cache (expire_at)")
+        self._writes = 0
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM response_cache WHERE key = ? AND expire_at > ?",
+                                     (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str, expire_at: float):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO response_cache (key, expire_at, value) VALUES (?, ?, ?)",
+                               (key, expire_at, value))
+            self._writes += 1
+            # 定期清理过期与超量的条目
+            if self._writes % 100 == 0:
+                self._conn.execute("DELETE FROM response_cache WHERE expire_at <= ?", (time.time(),))
+                self._conn.execute(
+                    "DELETE FROM response_cache WHERE key IN (SELECT key FROM response_cache "
+                    "ORDER BY expire_at DESC LIMIT -1 OFFSET ?)", (self.max_size,))
+
+
+class ResponseCache:
+    """
+    响应缓存，值是OpenAI格式的chat.completion响应体
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300, disk_path: str | None = None,
+                 disk_max_size: int = 100000, sampled: bool = False):
+        """
+        :param max_size: 内存缓存条数
+        :param ttl: 有效期（秒）
+        :param disk_path: sqlite文件路径，None表示不启用磁盘层
+        :param disk_max_size: 磁盘层最大条数
+        :param sampled: 是否也缓存采样的请求
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sampled = sampled
+        # key -> (过期时间, 响应体JSON)，按最近使用排序
+        self._memory: OrderedDict[str, tuple] = OrderedDict()
+        self._disk = _DiskTier(disk_path, disk_max_size) if disk_path else None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # 采样的请求，不查也不写缓存
+        self.bypassed = 0
+
+    def cacheable(self, data: Dict) -> bool:
+        """
+        请求是否使用缓存：采样的请求每次结果不同，缓存会让重试与多次采样得到同一个结果。
+        未设置temperature时按OpenAI的默认值1，视为采样
+        """
+        if self.sampled or ((data.get("n") or 1) <= 1 and data.get("temperature", 1) == 0):
+            return True
+        self.bypassed += 1
+        return False
+
+    async def get(self, key: str) -> Dict | None:
+        """
+        查缓存，返回响应体的副本
+        """
+        item = self._memory.get(key)
+        if item is not None:
+            if item[0] > time.monotonic():
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return ujson.loads(item[1])
+            del self._memory[key]
+
+        if self._disk:
+            try:
+                value = await asyncio.to_thread(self._disk.get, key)
+            except sqlite3.Error as e:
+                logger.warning(f"response cache disk tier error: {e}")
+                value = None
+            if value is not None:
+                self.disk_hits += 1
+                self._set_memory(key, value)
+                return ujson.loads(value)
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, completion: Dict):
+        """
+        写缓存
+        """
+        value = ujson.dumps(completion, ensure_ascii=False)
+        self._set_memory(key, value)
+        if self._disk:
+            try:
+                await asyncio.to_thread(self._disk.set, key, value, time.time() + self.ttl)
+            except sqlite3.Error as e:
+                logger.warning(f"response cache disk tier error: {e}")
+
+    def _set_memory(self, key: str, value: str):
+        if self.max_size <= 0:
+            return
+        self._memory[key] = (time.monotonic() + self.ttl, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict:
+        """
+        命中统计，仅限当前worker
+        """
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {"hits": hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.,
+                "evictions": self.evictions,
+                "bypassed": self.bypassed,
+                "memory_size": len(self._memory),
+                "memory_max_size": self.max_size,
+                "disk_enabled": self._disk is not None,
+                "pid": os.getpid()}
+
+
+_size = int(os.environ.get("RESPONSE_CACHE_SIZE", 0))
+_disk_path = os.environ.get("RESPONSE_CACHE_DISK_PATH")
+# 全局唯一的响应缓存，未配置时为None
+response_cache: None | ResponseCache = ResponseCache(
+    max_size=_size,
+    ttl=float(os.environ.get("RESPONSE_CACHE_TTL", 300)),
+    disk_path=_disk_path,
+    disk_max_size=int(os.environ.get("RESPONSE_CACHE_DISK_SIZE", 100000)),
+    sampled=os.environ.get("RESPONSE_CACHE_SAMPLED") == "1",
+) if _size > 0 or _disk_path else None
@@ -0,0 +1,147 @@
+"""
+相同请求的single-flight合并：同时在途的相同请求共享一次上游调用
+
+环境变量：
+    SINGLE_FLIGHT：设为1启用
+"""
+import asyncio
+import os
+from typing import AsyncGenerator, Awaitable, Callable, Dict, List
+
+from loguru import logger
+
+from utilities.response_cache import request_fingerprint
+
+# 不影响上游响应的字段。stream_options参与合并键：include_usage不同的流，上游的输出不同（是否带usage chunk）
+_IGNORED_KEYS = frozenset({"user"})
+
+
+def flight_key(data: Dict) -> str:
+    """
+    single-flight的合并键，改写后请求的规范化哈希
+
+    :param data: 改写后的请求体
+    """
+    return request_fingerprint(data, _IGNORED_KEYS)
+
+
+class _Flight:
+    """
+    一次在途的上游流，chunk缓存在内存里，迟到的订阅者先补发已错过的chunk
+    """
+
+    def __init__(self):
+        self.chunks: List = []
+        self.done = False
+        self.error: BaseException | None = None
+        self.subscribers = 0
+        self.task: asyncio.Task | None = None
+        self._changed = asyncio.Event()
+
+    def notify(self):
+        """
+        唤醒所有等待新chunk的订阅者
+        """
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self):
+        await self._changed.wait()
+
+
+class SingleFlight:
+    """
+    相同键的在途请求只调用一次上游
+    """
+
+    def __init__(self):
+        # 非流式：键 -> 上游调用的task
+        self._calls: Dict[str, asyncio.Task] = {}
+        # 流式：键 -> _Flight
+        self._flights: Dict[str, _Flight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, func: Callable[[], Awaitable]):
+        """
+        非流式调用。上游调用在独立的task里运行，发起者断开也不影响其他等待者
+
+        :param key: 请求键
+        :param func: 发起上游调用的函数
+        """
+        task = self._calls.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.create_task(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def stream(self, key: str, open_stream: Callable[[], AsyncGenerator]) -> AsyncGenerator:
+        """
+        流式调用，每个订阅者拿到独立的生成器，共享同一个上游chunk序列
+
+        :param key: 请求键
+        :param open_stream: 打开上游流的函数
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            self.leaders += 1
+            flight = _Flight()
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(self._pump(key, flight, open_stream()))
+        else:
+            self.coalesced += 1
+        return self._subscribe(flight)
+
+    async def _pump(self, key: str, flight: _Flight, stream_gen: AsyncGenerator):
+        """
+        读上游流并广播，与任何一个客户端的生命周期无关
+        """
+        try:
+            async for chunk in stream_gen:
+                flight.chunks.append(chunk)
+                flight.notify()
+        except asyncio.CancelledError:
+            logger.debug(f"single flight {key} cancelled, no subscribers left")
+            flight.error = asyncio.CancelledError()
+        except Exception as e:
+            flight.error = e
+        finally:
+            await stream_gen.aclose()
+            flight.done = True
+            self._flights.pop(key, None)
+            flight.notify()
+
+    @staticmethod
+    async def _subscribe(flight: _Flight) -> AsyncGenerator:
+        flight.subscribers += 1
+        inx = 0
+        try:
+            while True:
+                if inx < len(flight.chunks):
+                    yield flight.chunks[inx]
+                    inx += 1
+                elif flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                else:
+                    await flight.wait()
+        finally:
+            flight.subscribers -= 1
+            # 所有订阅者都断开了，上游输出不再有人需要
+            if flight.subscribers == 0 and not flight.done:
+                flight.task.cancel()
+
+    def stats(self) -> Dict:
+        return {"leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._calls) + len(self._flights),
+                "pid": os.getpid()}
+
+
+# 全局唯一的single-flight，未启用时为None
+single_flight: None | SingleFlight = SingleFlight() if os.environ.get("SINGLE_FLIGHT") == "1" else None
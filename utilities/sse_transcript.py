@@ -0,0 +1,312 @@
+"""
+上游响应的录制与回放：录制上游响应的原始字节与每个chunk的到达时间，回放时按录制的节奏（或加速、或不等待）原样送回，
+chunk的切分与录制时逐字节相同（包括从标记或多字节字符中间切开的chunk）。用于离线、可重复地重跑真实的工具调用对话，
+测量代理的CPU开销与延迟，见benchmarks/bench_replay.py
+
+录制在共用的上游传输层进行，openai库与httpx通道的请求都能录到；只录制经openai_stream处理的请求，透传请求不录制。
+
+环境变量：
+    SSE_RECORD_DIR：录制目录，设置后启用录制，每个worker写一个sse-<pid>.jsonl.gz
+    SSE_RECORD_SAMPLE_RATE：录制的请求比例，默认1
+    SSE_REPLAY_PATH：录制文件或目录，设置后不再请求上游，上游请求由录制回放
+    SSE_REPLAY_SPEED：回放速度，1（默认）为录制时的节奏，2为两倍速，0为不等待，用于测量代理本身的CPU开销
+"""
+import asyncio
+import base64
+import contextvars
+import glob
+import gzip
+import hashlib
+import os
+import queue
+import random
+import threading
+import time
+from collections import defaultdict
+from typing import AsyncIterator, Dict, Iterable, List, Tuple
+
+import httpx
+import ujson
+from loguru import logger
+
+# 当前处理的客户端请求：(请求体JSON, 规范化哈希)，未录制且未回放时为None
+_current_request: contextvars.ContextVar[Tuple[str, str] | None] = contextvars.ContextVar("sse_transcript_request",
+                                                                                         default=None)
+
+# 回放时/v1/models（预热与健康检查）的响应
+_MODELS_RESPONSE = {"object": "list", "data": []}
+
+
+def begin_request(data: Dict, sample: bool = True):
+    """
+    标记当前任务正在处理的客户端请求，需在请求改写之前调用。之后该任务发出的上游请求以此录制或匹配录制
+
+    :param sample: 是否录制本请求
+    """
+    if not sample:
+        _current_request.set(None)
+        return
+    # 键有序的哈希，与字段顺序无关；流式与非流式的录制不同，stream也参与
+    key = hashlib.sha256(ujson.dumps(data, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+    _current_request.set((ujson.dumps(data, ensure_ascii=False), key))
+
+
+def upstream_key(body: bytes) -> str:
+    """
+    上游请求体的哈希，回放时优先按它匹配
+    """
+    return hashlib.sha256(body).hexdigest()
+
+
+def load_transcripts(path: str) -> List[Dict]:
+    """
+    读取录制文件，path为目录时读取其中所有sse-*.jsonl.gz。写到一半的文件读到截断处为止
+    """
+    paths = sorted(glob.glob(os.path.join(path, "sse-*.jsonl.gz"))) if os.path.isdir(path) else [path]
+    transcripts = []
+    for file_path in paths:
+        try:
+            with gzip.open(file_path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        transcripts.append(ujson.loads(line))
+        except (EOFError, gzip.BadGzipFile, ValueError) as e:
+            logger.warning(f"transcript file {file_path} truncated: {e!r}")
+    return transcripts
+
+
+def transcript_body(transcript: Dict) -> bytes:
+    if "body_b64" in transcript:
+        return base64.b64decode(transcript["body_b64"])
+    return transcript["body"].encode()
+
+
+class _RecordingStream(httpx.AsyncByteStream):
+    """
+    转发上游响应的同时记录每个chunk的字节与到达时间，关闭时提交录制
+    """
+
+    def __init__(self, stream: httpx.AsyncByteStream, recorder: "TranscriptRecorder", transcript: Dict,
+                 start: float):
+        self._stream = stream
+        self._recorder = recorder
+        self._transcript = transcript
+        self._start = start
+        self._chunks: List[bytes] = []
+        self._times: List[float] = []
+        # 是否读到了上游响应的结尾，提前结束或客户端断开时为False
+        self._complete = False
+        self._submitted = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            self._times.append(time.perf_counter() - self._start)
+            self._chunks.append(chunk)
+            yield chunk
+        self._complete = True
+
+    async def aclose(self):
+        await self._stream.aclose()
+        if not self._submitted:
+            self._submitted = True
+            self._transcript["complete"] = self._complete
+            self._recorder.submit(self._transcript, self._chunks, self._times)
+
+
+class TranscriptRecorder:
+    """
+    录制上游响应，序列化与压缩写文件都在后台线程里做，不阻塞事件循环
+    """
+
+    def __init__(self, directory: str, sample_rate: float = 1., queue_size: int = 1024):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.path = os.path.join(directory, f"sse-{os.getpid()}.jsonl.gz")
+        self.written = 0
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._write_loop, name="sse-recorder", daemon=True)
+        self._thread.start()
+
+    def sample(self) -> bool:
+        """
+        本次请求是否录制
+        """
+        return random.random() < self.sample_rate
+
+    def wrap(self, request: httpx.Request, response: httpx.Response, start: float):
+        """
+        当前客户端请求需要录制时，替换上游响应的字节流，边转发边录制
+
+        :param start: 发出上游请求的时刻（perf_counter）
+        """
+        current = _current_request.get()
+        if current is None:
+            return
+        transcript = {"ts": time.time(),
+                      "method": request.method,
+                      "path": request.url.path,
+                      "request_key": current[1],
+                      "upstream_key": upstream_key(request.content),
+                      "status": response.status_code,
+                      "headers": [[k, v] for k, v in response.headers.items()],
+                      "ttfb_ms": round((time.perf_counter() - start) * 1000, 3),
+                      "request": current[0]}
+        response.stream = _RecordingStream(response.stream, self, transcript, start)
+
+    def submit(self, transcript: Dict, chunks: List[bytes], times: List[float]):
+        try:
+            self._queue.put_nowait((transcript, chunks, times))
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with gzip.open(self.path, "at", encoding="utf-8") as f:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                try:
+                    f.write(self._serialize(*item))
+                    # 每条录制写完即可读到，进程异常退出时只丢最后一条
+                    f.flush()
+                    self.written += 1
+                except Exception as e:
+                    logger.warning(f"transcript write error: {e!r}")
+
+    @staticmethod
+    def _serialize(transcript: Dict, chunks: List[bytes], times: List[float]) -> str:
+        body = b"".join(chunks)
+        try:
+            transcript["body"] = body.decode()
+        except UnicodeDecodeError:
+            # 压缩等非UTF-8的响应体
+            transcript["body_b64"] = base64.b64encode(body).decode()
+        # 每个chunk：[相对上游请求发出的毫秒数, 字节数]，回放时按字节数切分响应体
+        transcript["chunks"] = [[round(t * 1000, 3), len(chunk)] for t, chunk in zip(times, chunks)]
+        # 请求体已经是JSON字符串，直接拼接，不再解析一遍
+        request = transcript.pop("request")
+        return ujson.dumps(transcript, ensure_ascii=False)[:-1] + ',"request":' + request + "}\n"
+
+    def close(self):
+        """
+        写完队列里剩余的录制后结束后台线程
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self) -> Dict:
+        return {"pid": os.getpid(),
+                "path": self.path,
+                "sample_rate": self.sample_rate,
+                "written": self.written,
+                "dropped": self.dropped,
+                "pending": self._queue.qsize()}
+
+
+def _json_response(status: int, body: Dict) -> httpx.Response:
+    # 传输层返回的响应需要未读取的字节流，客户端以stream方式读取
+    content = ujson.dumps(body).encode()
+    return httpx.Response(status, headers={"content-type": "application/json", "content-length": str(len(content))},
+                          stream=httpx.ByteStream(content))
+
+
+class _ReplayStream(httpx.AsyncByteStream):
+    """
+    按录制的字节切分与时间送回响应体
+    """
+
+    def __init__(self, transcript: Dict, speed: float):
+        self._transcript = transcript
+        self._speed = speed
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        body = transcript_body(self._transcript)
+        start = time.perf_counter()
+        pos = 0
+        for at_ms, size in self._transcript["chunks"]:
+            if self._speed:
+                delay = (at_ms - self._transcript["ttfb_ms"]) / 1000 / self._speed - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                # 不等待时也让出事件循环，与真实上游一样每个chunk一次调度
+                await asyncio.sleep(0)
+            yield body[pos:pos + size]
+            pos += size
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """
+    用录制代替上游：先按上游请求体的哈希匹配，请求改写有变化时按客户端请求匹配，同一请求的多条录制轮流使用
+    """
+
+    def __init__(self, transcripts: Iterable[Dict], speed: float = 1.):
+        self.speed = speed
+        self._by_upstream: Dict[str, List[Dict]] = defaultdict(list)
+        self._by_request: Dict[str, List[Dict]] = defaultdict(list)
+        self._next: Dict[str, int] = defaultdict(int)
+        self.transcripts = 0
+        for transcript in transcripts:
+            self.transcripts += 1
+            self._by_upstream[transcript["upstream_key"]].append(transcript)
+            self._by_request[transcript["request_key"]].append(transcript)
+        self.hits = 0
+        self.request_hits = 0
+        self.misses = 0
+
+    def _pick(self, key: str, transcripts: List[Dict]) -> Dict:
+        inx = self._next[key]
+        self._next[key] = inx + 1
+        return transcripts[inx % len(transcripts)]
+
+    def _match(self, request: httpx.Request) -> Dict | None:
+        key = upstream_key(request.content)
+        if key in self._by_upstream:
+            self.hits += 1
+            return self._pick(key, self._by_upstream[key])
+        current = _current_request.get()
+        if current is not None and current[1] in self._by_request:
+            self.request_hits += 1
+            return self._pick(current[1], self._by_request[current[1]])
+        self.misses += 1
+        return None
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if request.method == "GET" and request.url.path.endswith("/models"):
+            # 预热与健康检查
+            return _json_response(200, _MODELS_RESPONSE)
+        await request.aread()
+        transcript = self._match(request)
+        if transcript is None:
+            return _json_response(404, {"error": {"message": "no recorded transcript for this request",
+                                                  "type": "replay_miss"}})
+        if self.speed:
+            await asyncio.sleep(transcript["ttfb_ms"] / 1000 / self.speed)
+        # 响应体按录制原样送回，去掉原响应的长度与编码头，由httpx按实际字节处理
+        headers = [(k, v) for k, v in transcript["headers"]
+                   if k.lower() not in ("content-length", "transfer-encoding", "connection")]
+        return httpx.Response(transcript["status"], headers=headers, stream=_ReplayStream(transcript, self.speed))
+
+    def stats(self) -> Dict:
+        return {"transcripts": self.transcripts,
+                "speed": self.speed,
+                "hits": self.hits,
+                "request_hits": self.request_hits,
+                "misses": self.misses}
+
+
+_record_dir = os.environ.get("SSE_RECORD_DIR")
+# 全局唯一的录制，未启用时为None
+sse_recorder: None | TranscriptRecorder = TranscriptRecorder(
+    directory=_record_dir,
+    sample_rate=float(os.environ.get("SSE_RECORD_SAMPLE_RATE", 1)),
+) if _record_dir else None
+
+_replay_path = os.environ.get("SSE_REPLAY_PATH")
+# 全局唯一的回放，未启用时为None
+sse_replay: None | ReplayTransport = ReplayTransport(
+    load_transcripts(_replay_path),
+    speed=float(os.environ.get("SSE_REPLAY_SPEED", 1)),
+) if _replay_path else None
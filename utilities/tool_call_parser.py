@@ -0,0 +1,238 @@
+"""
+工具调用的增量解析器，输出格式由方言（utilities.dialects）决定
+
+流式响应的每个delta只扫描一遍：当前方言的标记编译在同一个正则里，一次search找到下一个标记；
+跨chunk的标记状态保存在解析器里，缓存只保留可能是标记前缀的尾巴，因此每个delta的处理代价是摊还O(len(delta))。
+"""
+from typing import Dict, List, Tuple
+
+from utilities.dialects import DIALECTS, Dialect, JsonDialect
+
+# 事件类型
+CONTENT = "content"  # (CONTENT, 文本)
+TOOL_CALL = "tool_call"  # (TOOL_CALL, 工具调用序号, 函数名)
+ARGUMENTS = "arguments"  # (ARGUMENTS, 工具调用序号, 参数片段)
+TOOL_CALL_END = "tool_call_end"  # (TOOL_CALL_END, 工具调用序号)
+
+# 解析状态
+_TEXT = 0  # 普通回复内容
+_AWAIT_NAME = 1  # 等待函数名的起始标记
+_NAME = 2  # 函数名
+_AWAIT_ARGUMENTS = 3  # 等待参数的起始标记
+_ARGUMENTS = 4  # 参数
+_DONE = 5  # 达到工具调用数量上限，或工具调用块之后出现了其他内容
+_CALL = 6  # JSON方言：两个标记之间的JSON工具调用
+_AWAIT_CALL = 7  # JSON方言：等待下一个工具调用
+
+
+def _state_marks(dialect: Dialect) -> Dict[int, str | None]:
+    """
+    各状态下等待的标记，None表示该状态没有标记
+    """
+    if isinstance(dialect, JsonDialect):
+        return {_TEXT: dialect.tool_call_start, _CALL: dialect.tool_call_end, _AWAIT_CALL: dialect.next_tool_call}
+    return {_TEXT: dialect.tool_call_start,
+            _AWAIT_NAME: dialect.name_markers[0],
+            _NAME: dialect.name_markers[1],
+            _AWAIT_ARGUMENTS: dialect.arguments_markers[0],
+            _ARGUMENTS: dialect.arguments_markers[1]}
+
+
+def _partial_mark_len(text: str, mark: str, start: int) -> int:
+    """
+    text[start:]末尾可能是mark前缀的最大长度，这部分要留到下一个delta再判断
+    """
+    # 标记前缀必以标记首字符开头，先定位首字符，避免逐个长度比较
+    inx = text.find(mark[0], max(start, len(text) - len(mark) + 1))
+    while inx >= 0:
+        if mark.startswith(text[inx:]):
+            return len(text) - inx
+        inx = text.find(mark[0], inx + 1)
+    return 0
+
+
+class ToolCallStreamParser:
+    """
+    工具调用的流式解析器，每次feed一个delta，返回解析出的事件列表：
+
+    - (CONTENT, text)：工具调用块之前的普通回复内容
+    - (TOOL_CALL, index, name)：一个完整的函数名
+    - (ARGUMENTS, index, fragment)：参数JSON字符串的片段。函数名与参数分开标记的方言随模型输出逐步推出，
+      JSON方言在整个工具调用解析完后一次推出
+    - (TOOL_CALL_END, index)：该工具调用的参数已完整。上游在参数中途结束时没有这个事件
+    """
+
+    def __init__(self, dialect: Dialect | None = None, max_tool_calls: int = 5, stop_on_trailing_text: bool = True):
+        """
+        :param dialect: 模型输出的方言，默认qwen
+        :param max_tool_calls: 工具调用数量上限，达到后不再解析
+        :param stop_on_trailing_text: 工具调用块结束后出现非空白的其他内容时是否结束解析
+        """
+        self.dialect = dialect or DIALECTS["qwen"]
+        self.max_tool_calls = max_tool_calls
+        self.stop_on_trailing_text = stop_on_trailing_text
+        # 结束解析的原因：max_tool_calls或trailing_text
+        self.done_reason: str | None = None
+        # 已解析出的工具调用数量
+        self.tool_call_count = 0
+        # 是否进入过工具调用期
+        self.tool_calling = False
+        self._state = _TEXT
+        self._marks = _state_marks(self.dialect)
+        self._search = self.dialect.scanner.search
+        # 跨delta的未决尾巴，长度不超过当前标记
+        self._pending = ""
+        # 函数名片段，或JSON方言的工具调用片段
+        self._parts: List[str] = []
+        # JSON方言当前工具调用的起始标记，无法解析时与原文一起还原为回复内容
+        self._call_mark = ""
+
+    @property
+    def done(self) -> bool:
+        """
+        是否已结束解析，之后上游的输出不再需要
+        """
+        return self._state == _DONE
+
+    @property
+    def idle(self) -> bool:
+        """
+        是否处于普通回复状态且没有未决内容，此时不含工具调用起始标记首字符的delta可以原样转发
+        """
+        return self._state == _TEXT and not self._pending
+
+    def feed(self, delta: str | None) -> List[Tuple]:
+        """
+        解析一个delta
+
+        :param delta: 上游chunk中的content
+        :return: 事件列表
+        """
+        events = []
+        if not delta or self._state == _DONE:
+            return events
+
+        text = self._pending + delta if self._pending else delta
+        self._pending = ""
+        pos = 0
+        while self._state != _DONE:
+            mark = self._marks[self._state]
+            if mark is None:
+                self._consume(text[pos:], events)
+                break
+            mark_inx = self._find(text, mark, pos)
+            if mark_inx < 0:
+                # 没有完整标记，留下可能的标记前缀
+                keep = _partial_mark_len(text, mark, pos)
+                end = len(text) - keep
+                self._consume(text[pos:end], events)
+                self._pending = text[end:]
+                break
+            self._consume(text[pos:mark_inx], events)
+            if self._state == _DONE:
+                break
+            pos = mark_inx + len(mark)
+            self._advance(events)
+        return events
+
+    def _find(self, text: str, mark: str, pos: int) -> int:
+        """
+        用当前方言的扫描器找当前状态等待的标记，本方言的其他标记当作普通文本跳过
+        """
+        match = self._search(text, pos)
+        while match is not None:
+            inx = match.start()
+            if text.startswith(mark, inx):
+                return inx
+            match = self._search(text, inx + 1)
+        return -1
+
+    def finish(self) -> List[Tuple]:
+        """
+        上游结束时调用，推出未决内容
+        """
+        events = []
+        if self._pending and self._state in (_TEXT, _ARGUMENTS, _CALL):
+            self._consume(self._pending, events)
+        self._pending = ""
+        if self._state == _CALL:
+            # 没有结束标记的JSON工具调用，例如Llama 3生成结束时没有输出<|eom_id|>
+            self._emit_json_calls(events)
+        return events
+
+    def _consume(self, text: str, events: List[Tuple]):
+        """
+        处理两个标记之间的文本
+        """
+        if not text:
+            return
+        if self._state == _TEXT:
+            events.append((CONTENT, text))
+        elif self._state in (_NAME, _CALL):
+            self._parts.append(text)
+        elif self._state == _ARGUMENTS:
+            events.append((ARGUMENTS, self.tool_call_count, text))
+        elif self._state in (_AWAIT_NAME, _AWAIT_CALL) and self.tool_call_count and self.stop_on_trailing_text \
+                and text.strip():
+            # 工具调用块已结束，模型开始输出其他内容
+            self._state = _DONE
+            self.done_reason = "trailing_text"
+        # 等待标记期间的换行等内容直接丢弃
+
+    def _advance(self, events: List[Tuple]):
+        """
+        遇到当前状态的标记，切换到下一状态
+        """
+        if self._state == _TEXT:
+            self.tool_calling = True
+            self._call_mark = self.dialect.tool_call_start
+            self._state = _CALL if isinstance(self.dialect, JsonDialect) else _AWAIT_NAME
+        elif self._state == _AWAIT_NAME:
+            self._state = _NAME
+        elif self._state == _NAME:
+            events.append((TOOL_CALL, self.tool_call_count, ''.join(self._parts)))
+            self._parts.clear()
+            self._state = _AWAIT_ARGUMENTS
+        elif self._state == _AWAIT_ARGUMENTS:
+            self._state = _ARGUMENTS
+        elif self._state == _ARGUMENTS:
+            events.append((TOOL_CALL_END, self.tool_call_count))
+            self._count_tool_call(_AWAIT_NAME)
+        elif self._state == _CALL:
+            self._emit_json_calls(events, self.dialect.tool_call_end)
+        elif self._state == _AWAIT_CALL:
+            self._call_mark = self.dialect.next_tool_call
+            self._state = _CALL
+
+    def _count_tool_call(self, next_state: int):
+        self.tool_call_count += 1
+        # 控制工具调用数量
+        if self.tool_call_count >= self.max_tool_calls:
+            self._state = _DONE
+            self.done_reason = "max_tool_calls"
+        else:
+            self._state = next_state
+
+    def _emit_json_calls(self, events: List[Tuple], end_mark: str = ""):
+        """
+        解析缓存的JSON工具调用并推出。不合法的JSON找得到函数名时参数原样推出，由参数校验修复；
+        找不到函数名时连同标记还原为回复内容，没有解析出任何工具调用时回到普通回复状态
+
+        :param end_mark: 结束这段工具调用的标记，上游结束时为空
+        """
+        calls, unparsed = self.dialect.parse_calls(''.join(self._parts))
+        self._parts.clear()
+        # 结束标记之后不会再有工具调用的方言，之后的内容都是多余的
+        self._state = _AWAIT_CALL
+        if unparsed:
+            events.append((CONTENT, self._call_mark + unparsed + end_mark))
+            if not calls and not self.tool_call_count:
+                self.tool_calling = False
+                self._state = _TEXT
+        for name, arguments in calls:
+            events.append((TOOL_CALL, self.tool_call_count, name))
+            events.append((ARGUMENTS, self.tool_call_count, arguments))
+            events.append((TOOL_CALL_END, self.tool_call_count))
+            self._count_tool_call(_AWAIT_CALL)
+            if self._state == _DONE:
+                break
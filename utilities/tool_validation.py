@@ -0,0 +1,205 @@
+"""
+工具调用参数校验：按请求tools中的parameters（JSON Schema）校验每个解析出的工具调用，不合法时先在本地修复，
+仍不合法时可选向上游追问一次该工具调用的参数
+
+校验函数由fastjsonschema编译成Python代码，按schema的哈希缓存，同一个工具的后续请求只需一次函数调用。
+
+环境变量：
+    TOOL_ARGS_VALIDATION：设为1启用校验。启用后流式响应的参数不再逐段推出，每个工具调用校验后一次推出
+    TOOL_ARGS_REASK：设为1时，修复后仍不合法的工具调用向上游追问一次
+    TOOL_ARGS_REASK_MAX_TOKENS：追问的max_tokens，默认512
+"""
+import hashlib
+import os
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Tuple
+
+import fastjsonschema
+import ujson
+from loguru import logger
+
+from utilities import metrics
+
+_CACHE_SIZE = 1024
+
+# 校验结果
+VALID = "valid"  # 原样合法
+REPAIRED = "repaired"  # 本地修复后合法
+REASKED = "reasked"  # 追问后合法
+INVALID = "invalid"  # 仍不合法，原样返回
+UNKNOWN_TOOL = "unknown_tool"  # 函数名不在请求的tools里
+
+# 追问的提示词
+REASK_PROMPT = ("函数{name}的参数不符合要求：{error}\n"
+                "参数的JSON Schema：{schema}\n"
+                "只输出修正后的参数JSON对象，不要输出其他内容。")
+
+
+def _drop_trailing_comma(out: List[str]):
+    """
+    去掉out末尾（忽略空白）的逗号
+    """
+    i = len(out) - 1
+    while i >= 0 and out[i].isspace():
+        i -= 1
+    if i >= 0 and out[i] == ",":
+        del out[i]
+
+
+def repair_arguments(text: str) -> object | None:
+    """
+    本地修复常见的参数JSON错误：单引号字符串、多余的尾逗号、括号不配对（缺少的补上，多余的去掉）、未闭合的字符串，
+    以及```代码块包裹。只扫描一遍
+
+    :return: 修复后解析出的值，仍无法解析时为None
+    """
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        text = text.rsplit("```", 1)[0].strip()
+    if not text:
+        # 没有参数的函数
+        return {}
+    out = []
+    # 未闭合的括号对应的右括号
+    closers = []
+    quote = None
+    escape = False
+    for ch in text:
+        if quote:
+            if escape:
+                escape = False
+                if ch == "'":
+                    # JSON没有\'
+                    out[-1] = ch
+                    continue
+            elif ch == "\\":
+                escape = True
+            elif ch == quote:
+                quote = None
+                ch = '"'
+            elif ch == '"':
+                # 单引号字符串中的双引号
+                ch = '\\"'
+            out.append(ch)
+        elif ch == '"' or ch == "'":
+            quote = ch
+            out.append('"')
+        elif ch == "{" or ch == "[":
+            closers.append("}" if ch == "{" else "]")
+            out.append(ch)
+        elif ch == "}" or ch == "]":
+            # 多余的右括号丢掉
+            if closers and closers[-1] == ch:
+                closers.pop()
+                _drop_trailing_comma(out)
+                out.append(ch)
+        else:
+            out.append(ch)
+    if quote:
+        out.append('"')
+    for ch in reversed(closers):
+        _drop_trailing_comma(out)
+        out.append(ch)
+    try:
+        return ujson.loads("".join(out))
+    except ValueError:
+        return None
+
+
+class ToolArgumentsValidator:
+    """
+    工具调用参数的校验与修复，以及各结果的计数
+    """
+
+    def __init__(self, reask: bool = False, reask_max_tokens: int = 512):
+        self.reask = reask
+        self.reask_max_tokens = reask_max_tokens
+        # schema哈希 -> 编译后的校验函数，schema本身不合法时为None
+        self._compiled: Dict[str, Callable | None] = {}
+        self.outcomes = defaultdict(int)
+        self.compiles = 0
+        self.checks = 0
+        self.check_seconds = 0.
+
+    def _compile(self, schema: Dict) -> Callable | None:
+        key = hashlib.sha1(ujson.dumps(schema, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+        if key in self._compiled:
+            return self._compiled[key]
+        if len(self._compiled) >= _CACHE_SIZE:
+            self._compiled.clear()
+        try:
+            validate = fastjsonschema.compile(schema)
+        except fastjsonschema.JsonSchemaDefinitionException as e:
+            logger.warning(f"invalid tool parameters schema, not validated: {e}")
+            validate = None
+        self.compiles += 1
+        self._compiled[key] = validate
+        return validate
+
+    def validators(self, tools: List[Dict]) -> Dict[str, Callable | None]:
+        """
+        请求中各工具的校验函数
+
+        :param tools: 请求中的tools
+        :return: 函数名 -> 校验函数，没有parameters的工具为None
+        """
+        validators = {}
+        for tool in tools:
+            function = tool.get("function") or {}
+            if function.get("name"):
+                parameters = function.get("parameters")
+                validators[function["name"]] = self._compile(parameters) if isinstance(parameters, dict) else None
+        return validators
+
+    def check(self, validate: Callable | None, arguments: str) -> Tuple[str, str, str | None]:
+        """
+        校验一个工具调用的参数，JSON不合法时先本地修复，不计入结果统计（由record计数）
+
+        :param validate: 该工具的校验函数
+        :param arguments: 参数JSON字符串
+        :return: (参数JSON字符串，修复后为重新序列化的结果, VALID/REPAIRED/INVALID, 错误信息)
+        """
+        start = time.perf_counter()
+        try:
+            try:
+                value = ujson.loads(arguments)
+                outcome = VALID
+            except ValueError:
+                value = repair_arguments(arguments)
+                if value is None:
+                    return arguments, INVALID, "arguments are not valid JSON"
+                arguments = ujson.dumps(value, ensure_ascii=False, escape_forward_slashes=False)
+                outcome = REPAIRED
+            if not isinstance(value, dict):
+                return arguments, INVALID, "arguments must be a JSON object"
+            if validate is not None:
+                try:
+                    validate(value)
+                except fastjsonschema.JsonSchemaValueException as e:
+                    return arguments, INVALID, e.message
+            return arguments, outcome, None
+        finally:
+            self.checks += 1
+            self.check_seconds += time.perf_counter() - start
+
+    def record(self, outcome: str):
+        self.outcomes[outcome] += 1
+        metrics.TOOL_ARGUMENTS.labels(outcome).inc()
+
+    def stats(self) -> Dict:
+        return {"pid": os.getpid(),
+                "reask": self.reask,
+                "outcomes": dict(self.outcomes),
+                "compiled_schemas": len(self._compiled),
+                "compiles": self.compiles,
+                "checks": self.checks,
+                "avg_check_us": round(self.check_seconds * 1e6 / self.checks, 2) if self.checks else 0.}
+
+
+# 全局唯一的工具调用参数校验，未启用时为None
+tool_validator: None | ToolArgumentsValidator = ToolArgumentsValidator(
+    reask=os.environ.get("TOOL_ARGS_REASK") == "1",
+    reask_max_tokens=int(os.environ.get("TOOL_ARGS_REASK_MAX_TOKENS", 512)),
+) if os.environ.get("TOOL_ARGS_VALIDATION") == "1" else None
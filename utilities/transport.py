@@ -0,0 +1,148 @@
+"""
+上游连接池：openai库、httpx通道与透传请求共用同一个httpx.AsyncClient，复用连接，可选HTTP/2多路复用
+
+环境变量：
+    UPSTREAM_MAX_CONNECTIONS：连接数上限（所有上游合计），默认100
+    UPSTREAM_MAX_KEEPALIVE：保持的空闲连接数上限，默认20
+    UPSTREAM_KEEPALIVE_EXPIRY：空闲连接保持的时长（秒），默认5，不要超过上游的keep-alive时长（uvicorn与vLLM默认5秒）
+    UPSTREAM_HTTP2：设为1启用HTTP/2（需要安装h2），仅对https上游经ALPN协商生效，http上游仍为HTTP/1.1
+    UPSTREAM_CONNECT_TIMEOUT：建立连接的超时（秒），默认5
+    UPSTREAM_READ_TIMEOUT：两次读取之间的超时（秒），默认600，即长时间没有新chunk
+    UPSTREAM_WRITE_TIMEOUT：发送请求体的超时（秒），默认30
+    UPSTREAM_POOL_TIMEOUT：等待空闲连接的超时（秒），默认30
+    UPSTREAM_FIRST_BYTE_TIMEOUT：发出请求到收到响应头的超时（秒），未设置时不限制。非流式请求的响应头在生成结束后才返回
+    UPSTREAM_WARMUP_CONNECTIONS：启动时向每个上游预先建立的连接数，默认4，0表示不预热
+
+录制与回放上游响应见utilities.sse_transcript，回放时客户端使用回放的传输层，不再连接上游。
+"""
+import asyncio
+import os
+import time
+from typing import Dict, Iterable
+
+import httpx
+from loguru import logger
+
+from utilities import metrics
+from utilities.sse_transcript import sse_recorder, sse_replay
+
+
+class _TracingTransport(httpx.AsyncHTTPTransport):
+    """
+    记录每个请求是新建连接还是复用连接，限制首字节时间，启用录制时录制响应
+    """
+
+    def __init__(self, owner: "UpstreamTransport", first_byte_timeout: float | None, **kwargs):
+        super().__init__(**kwargs)
+        self._owner = owner
+        self._first_byte_timeout = first_byte_timeout
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        connected = False
+
+        async def trace(event_name: str, info: Dict):
+            nonlocal connected
+            if event_name == "connection.connect_tcp.complete":
+                connected = True
+
+        request.extensions["trace"] = trace
+        start = time.perf_counter()
+        try:
+            if self._first_byte_timeout is None:
+                response = await super().handle_async_request(request)
+            else:
+                response = await asyncio.wait_for(super().handle_async_request(request), self._first_byte_timeout)
+        except TimeoutError:
+            raise httpx.ReadTimeout(f"no response within {self._first_byte_timeout}s", request=request)
+        self._owner.record(connected)
+        if sse_recorder:
+            sse_recorder.wrap(request, response, start)
+        return response
+
+
+class UpstreamTransport:
+    """
+    全局共享的上游HTTP客户端
+    """
+
+    def __init__(self, max_connections: int = 100, max_keepalive: int = 20, keepalive_expiry: float = 5,
+                 http2: bool = False, connect_timeout: float = 5, read_timeout: float = 600,
+                 write_timeout: float = 30, pool_timeout: float = 30, first_byte_timeout: float | None = None,
+                 warmup_connections: int = 4):
+        self.http2 = http2
+        self.warmup_connections = warmup_connections
+        self.timeout = httpx.Timeout(connect=connect_timeout, read=read_timeout, write=write_timeout,
+                                     pool=pool_timeout)
+        self.requests = 0
+        self.new_connections = 0
+        self._transport = _TracingTransport(
+            self, first_byte_timeout, http2=http2,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive,
+                                keepalive_expiry=keepalive_expiry))
+        self.client = httpx.AsyncClient(transport=sse_replay or self._transport, timeout=self.timeout)
+
+    def record(self, connected: bool):
+        """
+        一个请求收到了响应头
+
+        :param connected: 是否为该请求新建了连接
+        """
+        self.requests += 1
+        self.new_connections += connected
+        metrics.UPSTREAM_CONNECTIONS.labels("new" if connected else "reused").inc()
+
+    async def warm_up(self, urls: Iterable[str], headers: Dict[str, str]):
+        """
+        向每个上游并发发出warmup_connections个请求，预先建立连接，失败不影响启动
+
+        :param urls: 上游的scheme与host
+        """
+        # HTTP/2的请求在同一连接上多路复用，一个连接就够
+        count = 1 if self.http2 else self.warmup_connections
+        if count <= 0:
+            return
+
+        async def probe(url: str):
+            try:
+                await self.client.get(f"{url}/v1/models", headers=headers)
+            except httpx.HTTPError as e:
+                logger.warning(f"warm up connection to {url} failed: {e!r}")
+
+        await asyncio.gather(*(probe(url) for url in urls for _ in range(count)))
+        logger.info(f"upstream connections warmed up: {self.connection_stats()}")
+
+    def connection_stats(self) -> Dict:
+        connections = [c for c in self._transport._pool.connections if not c.is_closed()]
+        return {"open": len(connections),
+                "in_use": sum(not c.is_idle() for c in connections),
+                "idle": sum(c.is_idle() for c in connections),
+                "http2": sum("HTTP/2" in c.info() for c in connections)}
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def stats(self) -> Dict:
+        return {"pid": os.getpid(),
+                "http2": self.http2,
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused": self.requests - self.new_connections,
+                "reuse_rate": (self.requests - self.new_connections) / self.requests if self.requests else 0.,
+                "connections": self.connection_stats(),
+                "replay": sse_replay.stats() if sse_replay else None}
+
+
+_first_byte_timeout = os.environ.get("UPSTREAM_FIRST_BYTE_TIMEOUT")
+# 全局唯一的上游客户端
+upstream_transport = UpstreamTransport(
+    max_connections=int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", 100)),
+    max_keepalive=int(os.environ.get("UPSTREAM_MAX_KEEPALIVE", 20)),
+    keepalive_expiry=float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY", 5)),
+    http2=os.environ.get("UPSTREAM_HTTP2") == "1",
+    connect_timeout=float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 5)),
+    read_timeout=float(os.environ.get("UPSTREAM_READ_TIMEOUT", 600)),
+    write_timeout=float(os.environ.get("UPSTREAM_WRITE_TIMEOUT", 30)),
+    pool_timeout=float(os.environ.get("UPSTREAM_POOL_TIMEOUT", 30)),
+    first_byte_timeout=float(_first_byte_timeout) if _first_byte_timeout else None,
+    warmup_connections=int(os.environ.get("UPSTREAM_WARMUP_CONNECTIONS", 4)),
+)
@@ -0,0 +1,196 @@
+"""
+多上游负载均衡：最少在途请求或EWMA延迟路由，主动健康检查，失败摘除与恢复
+
+环境变量：
+    OPENAI_BASE_URLS：逗号分隔的多个上游（以/v1结尾），未设置时使用OPENAI_BASE_URL
+    UPSTREAM_POLICY：least_outstanding（默认）或ewma
+    UPSTREAM_HEALTH_INTERVAL：健康检查间隔（秒），0表示不做主动检查
+    UPSTREAM_EJECT_FAILURES：连续失败多少次后摘除
+    UPSTREAM_EJECT_SECONDS：摘除时长（秒），到期或健康检查成功后恢复
+"""
+import asyncio
+import os
+import random
+import time
+from typing import Dict, Iterable, List
+from urllib.parse import urlparse
+
+import httpx
+from loguru import logger
+from openai import AsyncOpenAI
+
+from utilities.transport import upstream_transport
+
+API_KEY = os.environ.get("OPENAI_API_KEY")
+
+# EWMA平滑系数
+EWMA_ALPHA = 0.3
+
+
+class Upstream:
+    """
+    单个上游的状态
+    """
+
+    def __init__(self, base_url: str, max_retries: int = 2):
+        """
+        :param base_url: OpenAI兼容的API地址，以/v1结尾
+        :param max_retries: openai库在同一上游上的重试次数
+        """
+        parsed_url = urlparse(base_url)
+        # 只含scheme与host，拼接请求路径用
+        self.url = f"{parsed_url.scheme}://{parsed_url.netloc}"
+        self.host = parsed_url.netloc
+        self.api_base = base_url
+        self.max_retries = max_retries
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        # 首字节延迟的EWMA（秒）
+        self.ewma_latency: float | None = None
+        self.ejected_until = 0.
+        self._openai_client: None | AsyncOpenAI = None
+
+    @property
+    def available(self) -> bool:
+        return self.ejected_until <= time.monotonic()
+
+    @property
+    def openai_client(self) -> AsyncOpenAI:
+        # 所有上游共用同一个连接池
+        self._openai_client = self._openai_client or AsyncOpenAI(base_url=self.api_base,
+                                                                 max_retries=self.max_retries,
+                                                                 http_client=upstream_transport.client,
+                                                                 timeout=upstream_transport.timeout)
+        return self._openai_client
+
+    def stats(self) -> Dict:
+        return {"url": self.api_base,
+                "available": self.available,
+                "in_flight": self.in_flight,
+                "requests": self.requests,
+                "failures": self.failures,
+                "consecutive_failures": self.consecutive_failures,
+                "ewma_latency_ms": None if self.ewma_latency is None else round(self.ewma_latency * 1000, 3)}
+
+
+class UpstreamPool:
+    """
+    上游池，负责挑选上游、记录在途请求与延迟、摘除与恢复
+    """
+
+    def __init__(self, base_urls: List[str], policy: str = "least_outstanding", health_interval: float = 5,
+                 eject_failures: int = 3, eject_seconds: float = 30):
+        if policy not in ("least_outstanding", "ewma"):
+            raise ValueError(f"unknown upstream policy: {policy}")
+        # 多上游时由本池做故障转移，不在同一上游上重试
+        max_retries = 2 if len(base_urls) == 1 else 0
+        self.upstreams = [Upstream(base_url, max_retries) for base_url in base_urls]
+        self.policy = policy
+        self.health_interval = health_interval
+        self.eject_failures = eject_failures
+        self.eject_seconds = eject_seconds
+        # 请求失败前未产生首字节时，最多换几个上游重试
+        self.max_attempts = len(self.upstreams)
+        self._health_task: asyncio.Task | None = None
+
+    def pick(self, exclude: Iterable[Upstream] = ()) -> Upstream:
+        """
+        按策略挑选一个上游，优先未摘除的上游
+
+        :param exclude: 本次请求已经失败过的上游
+        """
+        candidates = [u for u in self.upstreams if u not in exclude] or self.upstreams
+        candidates = [u for u in candidates if u.available] or candidates
+        if len(candidates) == 1:
+            return candidates[0]
+        if self.policy == "ewma":
+            # 没有延迟数据的上游优先探测
+            return min(candidates, key=lambda u: (
+                (u.ewma_latency or 0.) * (u.in_flight + 1), random.random()))
+        return min(candidates, key=lambda u: (u.in_flight, random.random()))
+
+    def begin(self, upstream: Upstream):
+        """
+        请求发往上游
+        """
+        upstream.in_flight += 1
+        upstream.requests += 1
+
+    def end(self, upstream: Upstream, latency: float | None = None, failed: bool = False):
+        """
+        请求结束
+
+        :param latency: 首字节延迟（秒），失败时为None
+        :param failed: 是否失败
+        """
+        upstream.in_flight -= 1
+        if failed:
+            self.record_failure(upstream)
+        elif latency is not None:
+            self.record_success(upstream, latency)
+
+    def record_success(self, upstream: Upstream, latency: float | None = None):
+        upstream.consecutive_failures = 0
+        if upstream.ejected_until:
+            logger.info(f"upstream {upstream.api_base} recovered")
+            upstream.ejected_until = 0.
+        if latency is not None:
+            upstream.ewma_latency = latency if upstream.ewma_latency is None else \
+                EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * upstream.ewma_latency
+
+    def record_failure(self, upstream: Upstream):
+        upstream.failures += 1
+        upstream.consecutive_failures += 1
+        if upstream.consecutive_failures >= self.eject_failures and upstream.available:
+            logger.warning(f"upstream {upstream.api_base} ejected for {self.eject_seconds}s")
+            upstream.ejected_until = time.monotonic() + self.eject_seconds
+
+    async def _probe(self, client: httpx.AsyncClient, upstream: Upstream):
+        try:
+            response = await client.get(f"{upstream.url}/v1/models", timeout=self.health_interval,
+                                        headers={"Authorization": f"Bearer {API_KEY}"})
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logger.debug(f"upstream {upstream.api_base} health check failed: {e!r}")
+            self.record_failure(upstream)
+        else:
+            self.record_success(upstream)
+
+    async def _health_loop(self, client: httpx.AsyncClient):
+        while True:
+            await asyncio.gather(*(self._probe(client, upstream) for upstream in self.upstreams))
+            await asyncio.sleep(self.health_interval)
+
+    def start_health_checks(self, client: httpx.AsyncClient):
+        """
+        启动主动健康检查，单上游时不需要
+        """
+        if self.health_interval > 0 and len(self.upstreams) > 1 and self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop(client))
+
+    async def stop_health_checks(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+
+    def stats(self) -> Dict:
+        return {"policy": self.policy,
+                "pid": os.getpid(),
+                "upstreams": [upstream.stats() for upstream in self.upstreams]}
+
+
+# 全局唯一的上游池
+upstream_pool = UpstreamPool(
+    [url.strip() for url in (os.environ.get("OPENAI_BASE_URLS") or os.environ['OPENAI_BASE_URL']).split(",")
+     if url.strip()],
+    policy=os.environ.get("UPSTREAM_POLICY", "least_outstanding"),
+    health_interval=float(os.environ.get("UPSTREAM_HEALTH_INTERVAL", 5)),
+    eject_failures=int(os.environ.get("UPSTREAM_EJECT_FAILURES", 3)),
+    eject_seconds=float(os.environ.get("UPSTREAM_EJECT_SECONDS", 30)),
+)